@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Check: parse_rows puts every cell under the same column title as the SpanDictionary clustering it replaced
+# (columns keyed by their leftmost overlapping title, by at least overlap_size), over randomly placed tables,
+# plus the cases that have gone wrong before. Exits non-zero on any difference.
+# usage: python benchmarks/columns.py [--tables N] [--seed N]
+import os
+import sys
+import random
+import argparse
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from statements import Statement, PageIndex, BBox, SpanDictionary
+from synthetic import LayoutWriter
+
+def reference(index, cell_bbox, height = 20):
+    """(title, text line) counts from the original parse_rows: one SpanDictionary of columns, added to
+    title by title and then cell by cell, in document order"""
+    columns = SpanDictionary(merge_overlap = False)
+    headers = index.find('LTTextLineHorizontal', inside = BBox(x = cell_bbox.x, bottom = cell_bbox.top, height = height))
+    for header in sorted(headers, key = lambda i: i.bbox.y.min):
+        column = columns[header.bbox.x]
+        column['title'] = column['title'] + '\n' + header.text if 'title' in column else header.text
+    cells = collections.Counter()
+    unknown_column = 0
+    for cell in index.find('LTTextLineHorizontal', inside = cell_bbox):
+        if cell.text:
+            column = columns[cell.bbox.x]
+            if 'title' not in column:
+                column['title'] = unknown_column
+                unknown_column += 1
+            cells[column['title'], cell.text] += 1
+    return cells
+
+def parsed(index, cell_bbox, height = 20):
+    """The same counts from parse_rows, splitting the cells it joined back into lines"""
+    cells = collections.Counter()
+    for span, row in Statement.parse_rows(index, cell_bbox, height):
+        for title, text in row.items():
+            for line in text.split('\n'):
+                cells[title, line] += 1
+    return cells
+
+def table(headers, cells):
+    """A page with header lines [(x0, x1, text)] in the 20pt above y 700, and cells [(x0, x1, y, text)] below it"""
+    writer = LayoutWriter()
+    for x0, x1, text in headers:
+        writer.element('LTTextLineHorizontal', x0, 705, x1, 714, text)
+    for x0, x1, y, text in cells:
+        writer.element('LTTextLineHorizontal', x0, y, x1, y + 9, text)
+    return PageIndex.from_element(writer.page), BBox(left = 36, right = 576, bottom = 100, top = 700)
+
+# (headers, cells, the row parse_rows should read), for layouts that have been parsed wrong before
+cases = [
+    # a cell overlapping the column left of its own by less than overlap_size stays in its own column
+    ([(100, 130, 'Date'), (130.5, 200, 'Amount')], [(100, 125, 600, '01/02'), (129.5, 190, 600, '$5.00')],
+     {'Date': '01/02', 'Amount': '$5.00'}),
+]
+
+def random_table(rnd):
+    """Columns laid out like a statement's: titled ones and (at most) an untitled one, apart from each other,
+    with each cell near the left of its column but often running on under the next, some of them by less
+    than overlap_size. Titles don't overlap each other, and untitled cells don't reach a titled column.
+    Every cell overlaps its own column by a few points: a sliver that doesn't would start an untitled column,
+    which the SpanDictionary (keyed in document order) then let take the titled column's later cells."""
+    x, columns = 40.0, []
+    for n in range(rnd.randint(2, 6)):
+        width = rnd.uniform(10, 60)
+        columns.append((x, x + width, 'Title %d' % (n) if n != 1 or rnd.random() < 0.5 else None))
+        x += width + rnd.uniform(2, 80)
+    headers = [(x0, x1, title) for x0, x1, title in columns if title]
+    cells = []
+    for row in range(rnd.randint(1, 30)):
+        y = 680 - 14 * row
+        for n, (x0, x1, title) in enumerate(columns):
+            if rnd.random() < 0.3:
+                continue
+            left = x0 + rnd.uniform(-3, 3)
+            if title and n and columns[n - 1][2] and rnd.random() < 0.3:
+                left = max(columns[n - 1][1] - rnd.uniform(-0.5, 1.5), left) # barely touching the column to the left
+            following = columns[n + 1][0] if n + 1 < len(columns) else 576
+            right = left + rnd.uniform(2, 2 * (following - left)) if title else rnd.uniform(left + 2, following - 4)
+            right = max(right, x0 + 4)
+            cells.append((left, min(576, right), y + rnd.uniform(-1, 1), 'cell %d.%d' % (row, n)))
+    return headers, cells
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Check parse_rows\' columns against the SpanDictionary clustering.')
+    parser.add_argument('--tables', type = int, default = 2000)
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    failures = 0
+    for headers, cells, expected in cases:
+        index, cell_bbox = table(headers, cells)
+        rows = [row for span, row in Statement.parse_rows(index, cell_bbox)]
+        if rows != [expected]:
+            print "case %s: read %s, expected %s" % (headers, rows, expected)
+            failures += 1
+
+    rnd = random.Random(args.seed)
+    for n in range(args.tables):
+        index, cell_bbox = table(*random_table(rnd))
+        old, new = reference(index, cell_bbox), parsed(index, cell_bbox)
+        if old != new:
+            if failures < 10:
+                print "table %d: SpanDictionary only %s, parse_rows only %s" % (n, sorted(old - new), sorted(new - old))
+            failures += 1
+    print "%d cases, %d random tables: %d differ" % (len(cases), args.tables, failures)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Benchmark: time each parse stage over synthetic statements of increasing size,
+# optionally against a baseline saved by an earlier run (e.g. before a change).
+# usage: python benchmarks/pipeline.py [--rows N ...] [--repeat N] [--baseline FILE] [--save]
+# The layouts skip pdfminer, so the layout stage here only covers indexing the pages.
+import os
+import sys
+import json
+import argparse
+import collections
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from statements import Statement, Profiler, profiler
+from synthetic import generate, SyntheticPDF
+
+stages = ('total', 'document_map', 'page_index', 'assets', 'summary', 'table_data', 'parse_rows', 'merge_by_lines', 'cleanup')
+
+def run(tree):
+    profiler.reset()
+    with profiler.stage('total'):
+        statement = Statement('synthetic', pdf = SyntheticPDF(tree))
+        statement.load(tables = False)
+        records = list(statement.iter_records())
+    return profiler.report()['stages'], records
+
+def measure(rows, repeat):
+    """Best wall time per stage over repeat runs, plus the shape of the output to check it against"""
+    tree = generate(rows, rows)
+    best = dict()
+    for i in range(repeat):
+        report, records = run(tree)
+        for name, (calls, wall, cpu) in report.items():
+            best[name] = min(best.get(name, wall), wall)
+    sections = collections.Counter(record.section for record in records)
+    return dict(rows = rows, pages = len(tree.getroot()), records = len(records), sections = dict(sections), stages = best)
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Time the parse pipeline over synthetic statements.')
+    parser.add_argument('--rows', type = int, nargs = '+', default = [10, 50, 200, 500], help = 'rows per table (default: %(default)s)')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--baseline', default = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_baseline.json'))
+    parser.add_argument('--save', action = 'store_true', help = 'save this run as the baseline')
+    args = parser.parse_args()
+
+    baseline = dict()
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = dict((result['rows'], result) for result in json.load(f))
+
+    profiler.enabled = True
+    results = []
+    print "%6s %6s %8s " % ('rows', 'pages', 'records') + ' '.join("%14s" % i for i in stages) + " %12s" % 'us/record'
+    for rows in args.rows:
+        result = measure(rows, args.repeat)
+        results.append(result)
+        times = result['stages']
+        print "%6d %6d %8d " % (rows, result['pages'], result['records']) + \
+              ' '.join("%14.4f" % times.get(i, 0) for i in stages) + \
+              " %12.1f" % (1e6 * times['total'] / max(1, result['records']))
+
+        old = baseline.get(rows)
+        if old:
+            if old['sections'] != result['sections']:
+                print "%6s output differs from baseline: %s, was %s" % ('', result['sections'], old['sections'])
+            print "%6s %6s %8s " % ('', '', 'vs base') + \
+                  ' '.join("%13.2fx" % (times.get(i, 0) / old['stages'][i]) if old['stages'].get(i) else "%14s" % '-' for i in stages)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent = 1, sort_keys = True)
+        print "saved baseline to %s" % (args.baseline)
+
+if __name__ == '__main__':
+    main()
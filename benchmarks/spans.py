@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmark: SpanDictionary vs. the original linear-scan implementation
+# usage: python benchmarks/spans.py [rows...]
+import os
+import sys
+import copy
+import random
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from statements import Span, SpanDictionary
+
+# The original implementation, which scans every key on each lookup
+class LinearSpanDictionary(object):
+    def __init__(self, merge_overlap = True, overlap_size = 1):
+        self._items = dict()
+        self.merge_overlap = merge_overlap
+        self.overlap_size = overlap_size
+
+    def keys_overlaps(self, span):
+        keys = [i for i in self._items.iterkeys() if i.overlaps(span, self.overlap_size)]
+        if len(keys) > 1 and not self.merge_overlap: #take leftmost
+            keys = [ min(keys) ]
+        return keys
+
+    def __getitem__(self,span):
+        matching_keys = self.keys_overlaps(span)
+        if len(matching_keys) == 1:
+            return self._items[matching_keys[0]]
+        else:
+            key = copy.copy(span)
+            val = dict()
+            for i in matching_keys:
+                key = key.union(i)
+                val.update(self._items.pop(i))
+            self._items[key] = val
+            return val
+
+    def __len__(self): return self._items.__len__()
+
+def make_cells(rows, columns = 6, seed = 0):
+    # one LTTextLineHorizontal-sized cell per row/column, with a little jitter,
+    # and every third row carrying a second (wrapped) line in the first column
+    rnd = random.Random(seed)
+    cells = []
+    for row in range(rows):
+        bottom = 10000 - row * 12
+        for column in range(columns):
+            left = 36 + column * 90 + rnd.uniform(-2, 2)
+            y = Span(bottom + rnd.uniform(-0.2, 0.2), size = 9.248)
+            cells.append((Span(left, size = rnd.uniform(20, 80)), y))
+            if column == 0 and row % 3 == 0:
+                cells.append((Span(left, size = 60), Span(bottom - 10, size = 9.248)))
+    rnd.shuffle(cells)
+    return cells
+
+def classify(cls, cells):
+    rows = cls(merge_overlap = True)
+    columns = cls(merge_overlap = False)
+    for x, y in cells:
+        column = columns[x]
+        if not 'title' in column:
+            column['title'] = len(columns)
+        rows[y][column['title']] = True
+    return len(rows), len(columns)
+
+def main(sizes):
+    print "%8s %8s %12s %12s %8s" % ('rows', 'cells', 'linear (s)', 'indexed (s)', 'speedup')
+    for size in sizes:
+        cells = make_cells(size)
+        assert classify(LinearSpanDictionary, cells) == classify(SpanDictionary, cells)
+        repeat = max(1, 2000 // size)
+        linear = min(timeit.repeat(lambda: classify(LinearSpanDictionary, cells), number = 1, repeat = repeat))
+        indexed = min(timeit.repeat(lambda: classify(SpanDictionary, cells), number = 1, repeat = repeat))
+        print "%8d %8d %12.4f %12.4f %7.1fx" % (size, len(cells), linear, indexed, linear / indexed)
+
+if __name__ == '__main__':
+    main([int(i) for i in sys.argv[1:]] or [50, 200, 500, 1000, 2000])
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Benchmark: how long a fresh interpreter takes to import the library, and to get as far as the command line,
+# against bare Python startup. Importing statements shouldn't pull in the PDF stack (pdfquery, pyquery, lxml,
+# pdfminer) until something is actually laid out, or the modules only a batch parse or the server needs; the last
+# column lists any of them each case loads that bare Python doesn't, and it exits non-zero if the library imports do.
+# usage: python benchmarks/startup.py [--repeat N]
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+deferred = ('pdfquery', 'pyquery', 'lxml', 'pdfminer', 'multiprocessing', 'sqlite3', 'SocketServer', 'socket',
+            'cProfile', 'tempfile', 'csv', 'gzip', 'signal', 'base64', 'traceback')
+
+report = "import sys; print ' '.join(m for m in %r if m in sys.modules)" % (deferred,)
+# (name, code, whether it may load any of the deferred modules)
+cases = [
+    ('python', report, True),
+    ('import statements', 'import statements; ' + report, False),
+    ('geometry only', 'from statements import BBox, Span, SpanDictionary; ' + report, False),
+    ('+ PDF stack', 'import statements, pdfquery, pdfminer.pdfpage; ' + report, True),
+    ('statements_cli', 'import statements_cli; ' + report, True),
+]
+
+def run(command):
+    """Wall time to run command (in root), and the last line it printed"""
+    start = time.time()
+    output = subprocess.check_output(command, cwd = root)
+    return time.time() - start, (output.strip().splitlines() or [''])[-1]
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Time interpreter startup and library import.')
+    parser.add_argument('--repeat', type = int, default = 10)
+    args = parser.parse_args()
+
+    print "%-26s %10s %10s  %s" % ('', 'best ms', 'vs python', 'deferred modules loaded')
+    base = base_loaded = None
+    failures = 0
+    for name, code, allowed in cases:
+        results = [run([sys.executable, '-c', code]) for i in range(args.repeat)]
+        best = min(elapsed for elapsed, loaded in results)
+        loaded = set(results[-1][1].split())
+        if base is None: # bare python: whatever it loads itself (say from site) doesn't count against the others
+            base, base_loaded = best, loaded
+        loaded = sorted(loaded - base_loaded)
+        print "%-26s %10.1f %+10.1f  %s" % (name, 1000 * best, 1000 * (best - base), ' '.join(loaded) or '-')
+        if loaded and not allowed:
+            failures += 1
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
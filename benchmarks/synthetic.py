@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Synthetic statement layouts, in the shape pdfquery builds from a real statement
+# (LTPage > LTFigure header/footer, LTCurve gridlines, LTTextLineHorizontal text),
+# so the parse pipeline can be benchmarked without any real statements.
+# usage: python benchmarks/synthetic.py [activity rows] > layout.xml
+import os
+import sys
+import random
+from lxml import etree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 36
+LINE_HEIGHT = 9.248
+ROW_HEIGHT = 12
+CHAR_WIDTH = 4
+
+class LayoutWriter(object):
+    """Lays out elements top-down, starting a new page (with header and footer figures) when one fills up"""
+    content_top = PAGE_HEIGHT - 42
+    content_bottom = 40
+
+    def __init__(self):
+        self.root = etree.Element('pdfxml')
+        self.page = None
+        self.new_page()
+
+    def element(self, tag, x0, y0, x1, y1, text = None):
+        element = etree.SubElement(self.page, tag)
+        for name, value in zip(('x0', 'y0', 'x1', 'y1'), (x0, y0, x1, y1)):
+            element.set(name, str(round(value, 3)))
+        element.set('width', str(round(x1 - x0, 3)))
+        element.set('height', str(round(y1 - y0, 3)))
+        element.set('bbox', '[%s, %s, %s, %s]' % (round(x0, 3), round(y0, 3), round(x1, 3), round(y1, 3)))
+        if text is not None:
+            element.text = text
+        return element
+
+    def new_page(self):
+        index = len(self.root)
+        self.page = etree.SubElement(self.root, 'LTPage', page_index = str(index), page_label = str(index + 1),
+                                     x0 = '0', y0 = '0', x1 = str(PAGE_WIDTH), y1 = str(PAGE_HEIGHT))
+        self.element('LTFigure', 0, self.content_top, PAGE_WIDTH, PAGE_HEIGHT)
+        self.element('LTFigure', 0, 0, PAGE_WIDTH, self.content_bottom)
+        self.y = self.content_top - 6
+
+    def room(self, height):
+        """Start a new page unless height fits below the cursor"""
+        if self.y - height < self.content_bottom + 6:
+            self.new_page()
+            return False
+        return True
+
+    def text(self, x, top, text):
+        """A text line whose top is at top"""
+        return self.element('LTTextLineHorizontal', x, top - LINE_HEIGHT, x + max(1, len(text)) * CHAR_WIDTH, top, text)
+
+    def gridline(self, y, left = MARGIN, right = PAGE_WIDTH - MARGIN):
+        return self.element('LTCurve', left, y - 0.25, right, y + 0.25)
+
+def fund(rnd, i):
+    symbol = ''.join(rnd.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4)) + 'X'
+    return 'AMERICAN FUNDS %s FUND CL A' % (i), symbol
+
+def amount(rnd):
+    return '$%s' % ('{:,.2f}'.format(rnd.uniform(10, 20000)))
+
+def assets_table(writer, rnd, rows):
+    columns = [('Mutual funds', MARGIN + 2), ('Quantity', 300), ('Price', 380), ('Value', 480)]
+    def header(title):
+        writer.room(4 * ROW_HEIGHT)
+        writer.gridline(writer.y)
+        writer.y -= 4
+        for name, x in columns:
+            writer.text(x, writer.y, title if x == columns[0][1] else name)
+        writer.y -= ROW_HEIGHT
+        writer.gridline(writer.y)
+
+    header('Mutual funds')
+    for i in range(rows):
+        if not writer.room(2 * ROW_HEIGHT + 6 + 3 * ROW_HEIGHT):
+            header('Mutual funds, continued')
+        name, symbol = fund(rnd, i)
+        writer.y -= 3
+        writer.text(columns[0][1], writer.y, name)
+        writer.text(columns[1][1], writer.y, '%.3f' % rnd.uniform(1, 2000))
+        writer.text(columns[2][1], writer.y, '$%.2f' % rnd.uniform(5, 90))
+        writer.text(columns[3][1], writer.y, amount(rnd))
+        writer.text(columns[0][1], writer.y - ROW_HEIGHT, 'Quote Symbol: %s' % symbol)
+        writer.y -= 2 * ROW_HEIGHT + 3
+        writer.gridline(writer.y)
+    writer.y -= 6
+    writer.text(MARGIN + 2, writer.y, 'Total estimated asset value')
+    writer.text(480, writer.y, amount(rnd))
+    writer.y -= 2 * ROW_HEIGHT
+
+def activity_descriptions(section, rnd, i):
+    if section == 'Deposits':
+        return ['ELECTRONIC TRANSFER FROM CHECKING']
+    if section == 'Income':
+        return ['DIVIDEND ON AMERICAN FUNDS %d FUND CL A' % (i % 20)]
+    if section == 'Purchases':
+        if i % 3:
+            return ['REINVESTMENT INTO AMERICAN FUNDS %d FUND CL A' % (i % 20), '%.3f SHARES AT $%.2f' % (rnd.uniform(1, 9), rnd.uniform(5, 90))]
+        return ['SYSTEMATIC INVESTMENT PLAN AMERICAN FUNDS %d FUND CL A' % (i % 20),
+                '$25,000 BREAKPT; 5.75%% CHRG; %.3f SHARES' % (rnd.uniform(1, 9))]
+    return ['ACCOUNT FEE']
+
+def activity_table(writer, rnd, section, title, total, rows):
+    # the titles sit left of the cells, so the first column starts right of the longest one
+    columns = [('Date', 180), (None, 230), ('Amount', 510)]
+    def header(title):
+        writer.room(5 * ROW_HEIGHT)
+        writer.y -= 3
+        for name, x in columns:
+            if name:
+                writer.text(x, writer.y, name)
+        writer.y -= ROW_HEIGHT + 2
+        line = writer.y
+        writer.gridline(line)
+        writer.text(MARGIN, line - 2, title)
+
+    header(title)
+    for i in range(rows):
+        description = activity_descriptions(section, rnd, i)
+        height = len(description) * ROW_HEIGHT + 6
+        if not writer.room(height + 3 * ROW_HEIGHT):
+            header(title)
+        writer.y -= 3
+        writer.text(columns[0][1], writer.y, '%02d/%02d' % (1 + i % 12, 1 + i % 28))
+        for n, line in enumerate(description):
+            writer.text(columns[1][1], writer.y - n * ROW_HEIGHT, line)
+        writer.text(columns[2][1], writer.y, amount(rnd))
+        writer.y -= height - 3
+        writer.gridline(writer.y)
+    writer.y -= 6
+    writer.text(MARGIN, writer.y, total)
+    writer.text(columns[2][1], writer.y, amount(rnd))
+    writer.y -= 2 * ROW_HEIGHT
+
+activity_sections = [
+    ('Deposits', 'Deposits and transfers in', 'Total deposits and transfers in'),
+    ('Income', 'Income', 'Total income'),
+    ('Purchases', 'Withdrawals to purchase securities', 'Total withdrawals to purchase securities'),
+    ('Fees', 'Fees', 'Total fees'),
+]
+
+def generate(asset_rows = 20, activity_rows = 20, pages = 0, seed = 0):
+    """An lxml tree laid out like a statement, with the given rows per table, padded to at least pages pages"""
+    rnd = random.Random(seed)
+    writer = LayoutWriter()
+
+    writer.text(MARGIN, 589, 'Account number: 123-45678-1-2')
+    writer.text(MARGIN, 571, 'January 1 - January 31, 2014')
+    writer.y = 540
+
+    writer.text(MARGIN, writer.y, 'Your Assets at Edward Jones')
+    writer.y -= 2 * ROW_HEIGHT
+    assets_table(writer, rnd, asset_rows)
+
+    writer.room(10 * ROW_HEIGHT)
+    writer.text(MARGIN, writer.y, 'Summary of Your Investment Activity')
+    writer.y -= 2 * ROW_HEIGHT
+    for section, title, total in activity_sections:
+        writer.text(MARGIN + 10, writer.y, title)
+        writer.text(480, writer.y, amount(rnd))
+        writer.y -= ROW_HEIGHT
+    writer.y -= ROW_HEIGHT
+
+    writer.room(8 * ROW_HEIGHT)
+    writer.text(MARGIN, writer.y, 'Detail of Your Investment Activity')
+    writer.y -= 2 * ROW_HEIGHT
+    for section, title, total in activity_sections:
+        activity_table(writer, rnd, section, title, total, activity_rows)
+
+    while len(writer.root) < pages:
+        writer.new_page()
+        writer.text(MARGIN, writer.y, 'Important information about your statement')
+    return etree.ElementTree(writer.root)
+
+class SyntheticPDF(object):
+    """Stands in for pdfquery.PDFQuery, serving an already built layout tree"""
+    def __init__(self, tree):
+        self.tree = tree
+
+    def load(self, *page_numbers):
+        pass # already laid out
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    generate(rows, rows).write(sys.stdout, pretty_print = True)
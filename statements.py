@@ -1,22 +1,36 @@
 # -*- coding: utf-8 -*-
-import pdfquery
-import pyquery
+# The PDF stack (pdfquery, pyquery, lxml and pdfminer) is imported where it's used rather than up here: it's most
+# of the time it takes to start, and the geometry and table code doesn't need it. So are the modules only the
+# batch parse needs (multiprocessing, sqlite3, gzip, csv, cProfile...); the server is in statements_server.py.
+# See benchmarks/startup.py.
 import re
 import copy
+import bisect
+import array
 import datetime
 import os
 import sys
-import argparse
-import glob
 import itertools
 import time
-from lxml import etree
+import hashlib
+import functools
+import StringIO
+import collections
+import json
+import contextlib
+import resource
 
 # https://pythonhosted.org/pyquery/api.html
 # http://www.unixuser.org/~euske/python/pdfminer/programming.html
 
 # future: https://pypi.python.org/pypi/pdfminer3k
 
+# bump whenever a change here should invalidate the parse results the manifest and ledger keep
+PARSER_VERSION = '1'
+# bump whenever a change here alters the layout trees LayoutCache keeps (which don't depend on the table parsing,
+# so a parser fix can rerun an archive from its cached layouts); the pdfquery and pdfminer versions are keyed as well
+LAYOUT_VERSION = '1'
+
 def coalesce(*args):
     for arg in args:
         if arg is not None: return arg
@@ -33,19 +47,11 @@ def window_iterator(it, n):
         state = state[1:] + (item,)
         yield state
 
-#http://code.activestate.com/recipes/510402-attribute-proxy-forwarding-attribute-access/
-class forwardTo(object):
-    def __init__(self, objectName, attrName):
-        self.objectName = objectName
-        self.attrName = attrName
-    def __get__(self, instance, owner=None):
-        return getattr(getattr(instance, self.objectName), self.attrName)
-    def __set__(self, instance, value):
-        setattr(getattr(instance, self.objectName), self.attrName, value)
-    def __delete__(self, instance):
-        delattr(getattr(instance, self.objectName), self.attrName)
-        
+# Span and BBox use __slots__, since pages are made of thousands of them: no per-instance dict,
+# and BBox's edges are plain properties over its two Spans.
 class Span(object):
+    __slots__ = ('min', 'max')
+
     def __init__(self, min = None, max = None, size = None):
         if size is not None:
             if min is None: min = max - size
@@ -71,7 +77,13 @@ class Span(object):
     def union(self, other):
         return Span(min(self.min, other.min), max(self.max, other.max))
 
+    def copy(self):
+        return Span(self.min, self.max)
+    __copy__ = copy
+
 class BBox(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, xy=None,
                  left=None, right=None, top=None, bottom=None, # float
                  width=None, height=None, # float
@@ -82,8 +94,9 @@ class BBox(object):
             if height is None:
                 if y is None: y = xy
 
-        if isinstance(x, pyquery.PyQuery):  x = Span(float(x.attr('x0')), float(x.attr('x1')))
-        if isinstance(y, pyquery.PyQuery):  y = Span(float(y.attr('y0')), float(y.attr('y1')))     
+        pyquery = sys.modules.get('pyquery') # if it was never imported, these can't be PyQuery objects
+        if pyquery and isinstance(x, pyquery.PyQuery):  x = Span(float(x.attr('x0')), float(x.attr('x1')))
+        if pyquery and isinstance(y, pyquery.PyQuery):  y = Span(float(y.attr('y0')), float(y.attr('y1')))
 
         self.x = Span(left if left is not None else x.min if x is not None else None,
                       right if right is not None else x.max if x is not None else None,
@@ -92,16 +105,49 @@ class BBox(object):
                       top if top is not None else y.max if y is not None else None,
                       height)
 
+    @classmethod
+    def from_bounds(cls, left, bottom, right, top):
+        """Skips the keyword handling of the constructor, for building boxes in bulk"""
+        bbox = cls.__new__(cls)
+        bbox.x = Span(left, right)
+        bbox.y = Span(bottom, top)
+        return bbox
+
     def __repr__(self):
         return "%f,%f,%f,%f" % (self.x.min, self.y.min, self.x.max, self.y.max)
 
-    width = forwardTo('x','size')
-    left = forwardTo('x','min')
-    right = forwardTo('x','max')
+    def bounds(self):
+        return (self.x.min, self.y.min, self.x.max, self.y.max)
+
+    # copies the Spans too, so moving or expanding a copy leaves the original alone
+    def copy(self):
+        return BBox.from_bounds(self.x.min, self.y.min, self.x.max, self.y.max)
+    __copy__ = copy
+
+    @property
+    def width(self): return self.x.max - self.x.min
+    @property
+    def height(self): return self.y.max - self.y.min
+
+    @property
+    def left(self): return self.x.min
+    @left.setter
+    def left(self, value): self.x.min = value
+
+    @property
+    def right(self): return self.x.max
+    @right.setter
+    def right(self, value): self.x.max = value
+
+    @property
+    def bottom(self): return self.y.min
+    @bottom.setter
+    def bottom(self, value): self.y.min = value
 
-    height = forwardTo('y','size')
-    bottom = forwardTo('y','min')
-    top = forwardTo('y','max')
+    @property
+    def top(self): return self.y.max
+    @top.setter
+    def top(self, value): self.y.max = value
 
     def move(self,dX,dY):
         self.x.min += dX
@@ -117,16 +163,79 @@ class BBox(object):
         self.y.max += coalesce(top,    dY, d)
         return self
 
+# A batch of boxes stored as four arrays of edges, so one box can be tested against all of them
+# (or a slice of them) in one call, without going through a BBox and its Spans for each.
+# bounds are (left, bottom, right, top), or a BBox; results are indexes into the batch, in order.
+class BBoxArray(object):
+    __slots__ = ('lefts', 'bottoms', 'rights', 'tops')
+
+    def __init__(self, bboxes = ()):
+        self.lefts, self.bottoms, self.rights, self.tops = [array.array('d') for i in range(4)]
+        for bbox in bboxes:
+            self.append(bbox)
+
+    def append(self, bbox):
+        self.lefts.append(bbox.x.min)
+        self.bottoms.append(bbox.y.min)
+        self.rights.append(bbox.x.max)
+        self.tops.append(bbox.y.max)
+
+    def __len__(self): return len(self.lefts)
+
+    def __getitem__(self, i):
+        return BBox.from_bounds(self.lefts[i], self.bottoms[i], self.rights[i], self.tops[i])
+
+    def _edges(self, lo, hi):
+        if hi is None: hi = len(self.lefts)
+        return itertools.izip(xrange(lo, hi), self.lefts[lo:hi], self.bottoms[lo:hi], self.rights[lo:hi], self.tops[lo:hi])
+
+    def inside(self, bounds, lo = 0, hi = None):
+        """Indexes of the boxes (in [lo, hi)) that lie within bounds"""
+        left, bottom, right, top = bounds.bounds() if isinstance(bounds, BBox) else bounds
+        return [i for i, l, b, r, t in self._edges(lo, hi) if l >= left and r <= right and b >= bottom and t <= top]
+
+    def overlapping(self, bounds, lo = 0, hi = None):
+        """Indexes of the boxes (in [lo, hi)) that overlap or touch bounds"""
+        left, bottom, right, top = bounds.bounds() if isinstance(bounds, BBox) else bounds
+        return [i for i, l, b, r, t in self._edges(lo, hi) if l <= right and r >= left and b <= top and t >= bottom]
+
+    def containing(self, bounds, lo = 0, hi = None):
+        """Indexes of the boxes (in [lo, hi)) that enclose bounds"""
+        left, bottom, right, top = bounds.bounds() if isinstance(bounds, BBox) else bounds
+        return [i for i, l, b, r, t in self._edges(lo, hi) if l <= left and r >= right and b <= bottom and t >= top]
+
 class SpanDictionary(object):
+    # Keys are kept sorted by their lower bound (with a parallel list of the bounds for bisect),
+    # so overlap queries only examine the keys whose min falls in [span.min - largest key, span.max]
+    # instead of scanning every key.
     def __init__(self, merge_overlap = True, overlap_size = 1):
         self._items = dict()
+        self._keys = []
+        self._mins = []
+        self._max_size = 0 # upper bound on the size of any key
         self.merge_overlap = merge_overlap
         self.overlap_size = overlap_size
 
+    def _insert(self, key, value):
+        i = bisect.bisect_right(self._mins, key.min)
+        self._mins.insert(i, key.min)
+        self._keys.insert(i, key)
+        self._max_size = max(self._max_size, key.size)
+        self._items[key] = value
+
+    def _remove(self, key):
+        i = bisect.bisect_left(self._mins, key.min)
+        while self._keys[i] is not key: i += 1
+        del self._mins[i]
+        del self._keys[i]
+        return self._items.pop(key)
+
     def keys_overlaps(self, span):
-        keys = [i for i in self._items.iterkeys() if i.overlaps(span, self.overlap_size)]
+        lo = bisect.bisect_left(self._mins, span.min - self._max_size)
+        hi = bisect.bisect_right(self._mins, span.max)
+        keys = [i for i in self._keys[lo:hi] if i.overlaps(span, self.overlap_size)]
         if len(keys) > 1 and not self.merge_overlap: #take leftmost
-            keys = [ min(keys) ]
+            keys = keys[:1]
         return keys
 
     def __getitem__(self,span):
@@ -134,40 +243,130 @@ class SpanDictionary(object):
         if len(matching_keys) == 1:
             return self._items[matching_keys[0]]
         else:
-            key = copy.copy(span)
+            key = span.copy()
             val = dict()
             for i in matching_keys:
                 key = key.union(i)
-                val.update(self._items.pop(i))
-            self._items[key] = val
+                val.update(self._remove(i))
+            self._insert(key, val)
             return val
         
     def __delitem__(self,span):
-        self._items.__delitem__(span)
+        self._remove(span)
         
     def __contains__(self, span):
         return self.keys_overlaps(span).__nonzero__()
              
-    def __iter__(self): return self._items.__iter__()
+    def __iter__(self): return self._keys.__iter__()
     def __len__(self): return self._items.__len__()
     def __repr__(self): return self._items.__repr__()
+    # keys are always kept sorted, sort is accepted for compatibility
     def keys(self, sort = True, reverse = False):
-        keys = self._items.keys()
-        if sort: keys.sort(reverse = reverse)
+        keys = list(self._keys)
+        if reverse: keys.reverse()
         return keys
     def values(self, sort = True, reverse = False): return [self._items[i] for i in self.keys(sort, reverse)]
-    def items(self, sort = True, reverse = False):
-        items = self._items.items()
-        if sort: items.sort(key = lambda x: x[0], reverse = reverse)
-        return items
+    def items(self, sort = True, reverse = False): return [(i, self._items[i]) for i in self.keys(sort, reverse)]
+
+def sweep_spans(spans, overlap_size = 1, merge = True):
+    """Cluster spans that overlap (by at least overlap_size, as in Span.overlaps) with one sweep over them
+    in order of their lower bounds. Like a SpanDictionary(merge_overlap = True), except that a cluster always spans
+    all of its members, whatever order they come in.
+    Without merge a cluster keeps the extent of its first span, like the keys of a SpanDictionary(merge_overlap = False).
+    Returns the clusters' Spans in ascending order, and the cluster number of each of the spans."""
+    order = sorted(range(len(spans)), key = lambda i: spans[i].min)
+    clusters = []
+    labels = [None] * len(spans)
+    for i in order:
+        span = spans[i]
+        # sorted by min, so only the last cluster can still overlap
+        if clusters and span.overlaps(clusters[-1], overlap_size):
+            if merge:
+                clusters[-1].max = max(clusters[-1].max, span.max)
+        else:
+            clusters.append(span.copy())
+        labels[i] = len(clusters) - 1
+    return clusters, labels
+
+# Per-stage wall/CPU timers and per-page counters for the parse pipeline.
+# Disabled (and nearly free) unless enabled; parse_file resets the module-level profiler for each file.
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stages = dict() # name -> [calls, wall, cpu]
+        self.pages = dict() # page index -> {counter: n}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        wall, cpu = time.time(), time.clock()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += time.time() - wall
+            stage[2] += time.clock() - cpu
+
+    def timed(self, name):
+        """Decorator form of stage()"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, page, counter, n = 1):
+        if self.enabled:
+            counters = self.pages.setdefault(page, dict())
+            counters[counter] = counters.get(counter, 0) + n
+
+    def report(self):
+        return dict(stages = copy.deepcopy(self.stages), pages = copy.deepcopy(self.pages))
+
+    @staticmethod
+    def merge(total, report):
+        """Add one report() into another (e.g. to aggregate a batch)"""
+        for name, (calls, wall, cpu) in report['stages'].items():
+            stage = total['stages'].setdefault(name, [0, 0.0, 0.0])
+            stage[0] += calls
+            stage[1] += wall
+            stage[2] += cpu
+        for page, counters in report['pages'].items():
+            target = total['pages'].setdefault(page, dict())
+            for counter, n in counters.items():
+                target[counter] = target.get(counter, 0) + n
+        return total
+
+    @staticmethod
+    def format(report, pages = True):
+        lines = ["  %-16s %8s %10s %10s" % ('stage', 'calls', 'wall (s)', 'cpu (s)')]
+        for name, (calls, wall, cpu) in sorted(report['stages'].items(), key = lambda i: -i[1][1]):
+            lines.append("  %-16s %8d %10.4f %10.4f" % (name, calls, wall, cpu))
+        if pages and report['pages']:
+            counters = sorted(set(itertools.chain.from_iterable(report['pages'].values())))
+            lines.append("  %-10s" % 'page' + ''.join(" %16s" % i for i in counters))
+            for page, values in sorted(report['pages'].items()):
+                lines.append("  %-10s" % page + ''.join(" %16d" % values.get(i, 0) for i in counters))
+        return '\n'.join(lines)
+
+profiler = Profiler()
 
 class page_range(object):
-    def __init__(self, begin, end = None, **attrfuncs):
-        self.begin = begin.parents('LTPage')
-        if end:
-            self.endpage = end.parents('LTPage')[0]
-        else:
-            self.endpage = None
+    # Steps through page numbers from begin (through end, if given).
+    # pages(n) says whether page n exists, so a lazily loaded Statement can lay it out when the range gets there.
+    def __init__(self, begin, end = None, pages = None, **attrfuncs):
+        self.begin = begin
+        self.endpage = end
+        self.pages = pages
+        self.page = None
         self.attrfuncs = attrfuncs
         for key in attrfuncs.keys():
             setattr(self,key,None)
@@ -175,16 +374,18 @@ class page_range(object):
     def __iter__(self): return self
 
     def next(self):
-        if self.begin:
+        if self.begin is not None:
             self.page = self.begin
             self.begin = None
-        else:
-            if self.page[0] is self.endpage:
+        elif self.page is not None:
+            if self.page == self.endpage:
                 self.page = None
             else:
-                self.page = self.page.next('LTPage')
-            
-        if not self.page:
+                self.page += 1
+
+        if self.page is not None and self.pages and not self.pages(self.page):
+            self.page = None
+        if self.page is None:
             raise StopIteration
 
         for key, func in self.attrfuncs.items():
@@ -192,6 +393,17 @@ class page_range(object):
                     
         return self.page
 
+    def seek(self, page):
+        """Jump ahead to a later page, skipping the pages in between"""
+        self.begin = None
+        self.page = page
+        if self.pages and not self.pages(self.page):
+            self.page = None
+            return None
+        for key, func in self.attrfuncs.items():
+            setattr(self, key, func(self.page))
+        return self.page
+
 # A generator form of the above
 # somewhat shorter, but can't easily store the page/bbox when multiple passes chew on the same next()
 #def page_generator(begin, end = None):
@@ -201,215 +413,1085 @@ class page_range(object):
 #        yield page
 #        if end and page[0] is end.parents('LTPage')[0]: break
 #        page = page.next('LTPage')
-                  
-class Statement(object):
-    def __init__(self, filename):
-        self.filename = filename
-        self.pdf = pdfquery.PDFQuery(filename)
 
-    def load(self):
-        self.pdf.load()
+# same as PyQuery.text()
+def element_text(element):
+    return ' '.join(t.strip() for t in element.itertext() if t.strip())
+
+# the selectors saw bboxes formatted by BBox.__repr__, so compare at the same precision
+def rounded_bounds(bbox):
+    return tuple(round(i, 6) for i in bbox.bounds())
+
+def bbox_inside(bbox, bounds):
+    left, bottom, right, top = bounds
+    return bbox.left >= left and bbox.right <= right and bbox.bottom >= bottom and bbox.top <= top
+
+_whitespace = re.compile(r'\s+')
+
+# same as pdfquery's normalize_spaces, and the same type lxml gives pdfquery: str if it's ASCII, else unicode
+def layout_text(obj):
+    text = _whitespace.sub(' ', obj.get_text()).strip()
+    try:
+        return str(text)
+    except UnicodeEncodeError:
+        return text
+
+# A text line, curve or figure from either an lxml LTPage (pdfquery) or a pdfminer layout
+class PageItem(object):
+    def __init__(self, tag, order, bbox, text):
+        self.tag = tag
+        self.order = order # position in document order
+        self.bbox = bbox
+        self.text = text
+
+    @classmethod
+    def from_element(cls, element, order, text = None):
+        return cls(element.tag, order,
+                   BBox.from_bounds(float(element.get('x0')), float(element.get('y0')),
+                                    float(element.get('x1')), float(element.get('y1'))),
+                   text if text is not None else element_text(element))
+
+    @classmethod
+    def from_layout(cls, obj, order):
+        # pdfquery rounds to 3 digits, do the same so both backends see the same geometry
+        return cls(obj.__class__.__name__, order,
+                   BBox.from_bounds(round(obj.x0, 3), round(obj.y0, 3), round(obj.x1, 3), round(obj.y1, 3)),
+                   layout_text(obj) if hasattr(obj, 'get_text') else '')
 
-        account = self.pdf.pq('LTTextLineHorizontal:in_bbox("0,522,288,612"):contains("Account number:")').eq(0)
-        page = account.parents('LTPage')
-        account_bbox = BBox(account)
-        self.account = re.search(r'Account number:\s*([\d-]*)',unpretty(account.text())).group(0)
+    def __repr__(self):
+        return "<%s %s>" % (self.tag, self.bbox)
+
+# Spatial index of one LTPage's layout elements, so geometric lookups don't re-run a selector
+# (and re-parse every bbox attribute) over the page's subtree each time.
+# Items of each tag are sorted by bottom edge; a query bisects to the items whose bottom could
+# fall within the requested bbox, then checks the rest of the geometry on the decoded floats.
+# Results come back in document order, like the pyquery selectors they replace.
+class PageIndex(object):
+    tags = ('LTTextLineHorizontal', 'LTCurve', 'LTFigure')
+
+    def __init__(self, number, bbox, items):
+        """items are PageItems, in document order"""
+        self.number = number
+        self.bbox = bbox
+        self._items = dict((tag, []) for tag in self.tags)
+        for item in items:
+            self._items[item.tag].append(item)
+
+        self._fingerprint = None
+        self._boxes = dict() # a BBoxArray per tag, in the same order as its items
+        self._max_height = dict()
+        for tag, items in self._items.items():
+            items.sort(key = lambda i: i.bbox.y.min)
+            self._boxes[tag] = BBoxArray(i.bbox for i in items)
+            self._max_height[tag] = max([i.bbox.height for i in items] or [0])
+
+    def find(self, tag, inside = None, overlaps = None, contains = None):
+        """Items of the given tag within (or overlapping) a BBox, optionally containing some text.
+        Equivalent to page.find('tag:in_bbox("inside"):overlaps_bbox("overlaps"):contains("contains")')"""
+        items, boxes = self._items[tag], self._boxes[tag]
+        bottoms = boxes.bottoms
+        lo, hi = 0, len(items)
+        if inside is not None:
+            in_bounds = in_left, in_bottom, in_right, in_top = rounded_bounds(inside)
+            lo = max(lo, bisect.bisect_left(bottoms, in_bottom))
+            hi = min(hi, bisect.bisect_right(bottoms, in_top))
+        if overlaps is not None:
+            ov_bounds = ov_left, ov_bottom, ov_right, ov_top = rounded_bounds(overlaps)
+            lo = max(lo, bisect.bisect_left(bottoms, ov_bottom - self._max_height[tag]))
+            hi = min(hi, bisect.bisect_right(bottoms, ov_top))
+
+        profiler.count(self.number, 'selectors')
+        profiler.count(self.number, 'elements scanned', max(0, hi - lo))
+        if lo >= hi:
+            return []
+        matches = xrange(lo, hi)
+        if inside is not None:
+            matches = boxes.inside(in_bounds, lo, hi)
+        if overlaps is not None:
+            overlapping = boxes.overlapping(ov_bounds, lo, hi)
+            if inside is not None:
+                overlapping = set(overlapping)
+                matches = [i for i in matches if i in overlapping]
+            else:
+                matches = overlapping
+        found = [items[i] for i in matches]
+        if contains is not None:
+            found = [item for item in found if contains in item.text]
+        found.sort(key = lambda i: i.order)
+        return found
+
+    def items(self, tag):
+        """All the items of a tag, in document order"""
+        return sorted(self._items[tag], key = lambda i: i.order)
+
+    def at(self, tag, bounds):
+        """Items of the given tag with exactly these (left, bottom, right, top) bounds"""
+        boxes = self._boxes[tag]
+        left, bottom, right, top = bounds
+        lo = bisect.bisect_left(boxes.bottoms, bottom)
+        hi = bisect.bisect_right(boxes.bottoms, bottom)
+        return [self._items[tag][i] for i in range(lo, hi)
+                if boxes.lefts[i] == left and boxes.rights[i] == right and boxes.tops[i] == top]
+
+    def tallest(self, tag):
+        return self._max_height[tag]
+
+    def count(self, tag, bottom, top):
+        """How many items of the given tag have their bottom edge within [bottom, top], wherever they are across the page"""
+        bottoms = self._boxes[tag].bottoms
+        return bisect.bisect_right(bottoms, top) - bisect.bisect_left(bottoms, bottom)
+
+    def fingerprint(self):
+        """The page size and where its figures (letterhead, footer...) are, which pages of one statement format share"""
+        if self._fingerprint is None:
+            self._fingerprint = (self.bbox.bounds(),) + tuple(sorted(i.bbox.bounds() for i in self._items['LTFigure']))
+        return self._fingerprint
+
+    @classmethod
+    def from_element(cls, page):
+        """Index an lxml LTPage, as built by pdfquery"""
+        return cls(int(page.get('page_index', -1)), PageItem.from_element(page, -1).bbox,
+                   [PageItem.from_element(element, order) for order, element in enumerate(page.iter(*cls.tags))])
+
+    @classmethod
+    def from_layout(cls, layout, number):
+        """Index a pdfminer LTPage directly. Document order is pdfminer's (depth first), which is the order
+        pdfquery builds its tree in before re-sorting elements into whatever elements contain them."""
+        from pdfminer.layout import LTContainer
+        items = []
+        def walk(container):
+            for obj in container:
+                name = obj.__class__.__name__
+                if name in cls.tags:
+                    items.append(PageItem.from_layout(obj, len(items)))
+                if name != 'LTTextLineHorizontal' and isinstance(obj, LTContainer):
+                    walk(obj)
+        walk(layout)
+        return cls(number, PageItem.from_layout(layout, -1).bbox, items)
+
+# Where each anchor text (section titles, totals, the account header...) occurs in the document,
+# found in one pass over the text lines as pages are loaded, so the table parsers can jump straight
+# to their regions instead of searching page after page with :contains() selectors.
+class DocumentMap(object):
+    def __init__(self, anchors):
+        self._pattern = re.compile('|'.join(re.escape(i) for i in anchors))
+        self._found = dict((anchor, []) for anchor in anchors) # anchor -> [(page number, PageItem)] in document order
+
+    def _add(self, number, item):
+        for anchor, found in self._found.items():
+            if anchor in item.text:
+                found.append((number, item))
+
+    def add_page(self, number, page):
+        """Scan an lxml LTPage"""
+        for order, element in enumerate(page.iter('LTTextLineHorizontal')):
+            text = element_text(element)
+            if self._pattern.search(text): # cheap rejection of the vast majority of lines
+                self._add(number, PageItem.from_element(element, order, text))
+
+    def add_index(self, index):
+        """Scan an already built PageIndex"""
+        for item in index.items('LTTextLineHorizontal'):
+            if self._pattern.search(item.text):
+                self._add(index.number, item)
+
+    def next(self, anchor, page = 0, inside = None):
+        """The first (page number, PageItem) for anchor on or after page number page, optionally inside a BBox"""
+        bounds = rounded_bounds(inside) if inside is not None else None
+        for found in self._found[anchor]:
+            if found[0] >= page and (bounds is None or bbox_inside(found[1].bbox, bounds)):
+                return found
+        return None
+
+    def find(self, anchor, page, inside = None):
+        """PageItems for anchor on page number page, optionally inside a BBox, in document order"""
+        bounds = rounded_bounds(inside) if inside is not None else None
+        return [item for number, item in self._found[anchor]
+                if number == page and (bounds is None or bbox_inside(item.bbox, bounds))]
+
+# Statements of one format lay their pages out the same way, so what the parse works out about a page's structure
+# (its content area, the band between a table header's gridlines, a table's columns and their titles) is remembered
+# per page fingerprint, across statements. The next time the same question comes up on a page with that fingerprint,
+# the remembered answer is only checked against the evidence it was worked out from; if that has changed, the answer
+# is worked out again (and remembered in place of the old one).
+# Questions are keyed by positions on the page, so a long running process (such as a server worker) keeps meeting
+# new ones; only the most recently used max_questions per fingerprint, and max_fingerprints, are kept.
+class LayoutTemplates(object):
+    def __init__(self, max_questions = 64, max_fingerprints = 32):
+        self.enabled = True
+        self.hits = self.misses = 0
+        self.max_questions = max_questions
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> {question: (evidence, answer)}, both least recently used first
+        self._templates = collections.OrderedDict()
+
+    def recall(self, index, question, discover, check):
+        """The answer to question (a hashable key) about the page in index.
+        discover() works it out from scratch, returning (evidence, answer); check(evidence) says whether a
+        remembered answer still holds for this page. Answers are shared, so callers must not change them."""
+        if not self.enabled:
+            return discover()[1]
+        fingerprint = index.fingerprint()
+        template = self._templates.pop(fingerprint, None)
+        if template is None:
+            template = collections.OrderedDict()
+        self._templates[fingerprint] = template # now the most recently used
+        if len(self._templates) > self.max_fingerprints:
+            self._templates.popitem(last = False)
+        remembered = template.pop(question, None)
+        if remembered is not None:
+            template[question] = remembered
+            evidence, answer = remembered
+            if check(evidence):
+                self.hits += 1
+                profiler.count(index.number, 'template hits')
+                return answer
+        self.misses += 1
+        profiler.count(index.number, 'template misses')
+        evidence, answer = template[question] = discover()
+        if len(template) > self.max_questions:
+            template.popitem(last = False)
+        return answer
+
+    def clear(self):
+        self._templates.clear()
+
+layout_templates = LayoutTemplates()
+
+# Content-addressed on-disk cache for the layout tree pdfquery builds (which is most of the cost of load())
+# Entries are keyed by a hash of the PDF bytes plus LAYOUT_VERSION and the pdfquery and pdfminer versions, and the least recently
+# used entries are evicted once the directory grows past max_size bytes (down to low_water of it, so the next
+# eviction waits for that much more to be written). A process only lists the directory the first time it writes
+# there and when it evicts; in between it adds up what it writes itself.
+# Implements the parse_tree_cacher interface of pdfquery.cache.BaseCache (without importing pdfquery to subclass it).
+class LayoutCache(object):
+    suffix = '.xml.gz'
+    low_water = 0.9
+    _sizes = dict() # directory -> bytes of entries, as of this process's last listing plus what it has written since
+    _versions = None # what a layout depends on besides the PDF, worked out once per process
+
+    def __init__(self, directory, max_size = 512*1024*1024):
+        self.hash_key = None
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @classmethod
+    def versions(cls):
+        """LAYOUT_VERSION and the pdfminer and pdfquery versions (pdfquery only has one in its distribution)"""
+        if cls._versions is None:
+            import pdfminer
+            import pkg_resources
+            try:
+                pdfquery_version = pkg_resources.get_distribution('pdfquery').version
+            except pkg_resources.DistributionNotFound:
+                pdfquery_version = 'unknown'
+            cls._versions = '%s\0%s\0%s\0' % (LAYOUT_VERSION, pdfminer.__version__, pdfquery_version)
+        return cls._versions
+
+    def set_hash_key(self, file):
+        filehasher = hashlib.sha1()
+        filehasher.update(self.versions())
+        for data in iter(lambda: file.read(65536), ''):
+            filehasher.update(data)
+        file.seek(0)
+        self.hash_key = filehasher.hexdigest()
+
+    def get_cache_filename(self, page_range_key):
+        return os.path.join(self.directory, self.hash_key + page_range_key + self.suffix)
+
+    def get(self, page_range_key):
+        import gzip
+        from lxml import etree
+        filename = self.get_cache_filename(page_range_key)
+        try:
+            with gzip.open(filename, 'rb') as f:
+                tree = etree.parse(f)
+        except (IOError, etree.XMLSyntaxError):
+            self.misses += 1
+            return None
+        os.utime(filename, None) # mark as recently used
+        self.hits += 1
+        return tree
+
+    def set(self, page_range_key, tree):
+        filename = self.get_cache_filename(page_range_key)
+        # write and rename, so a concurrent reader never sees a partial entry
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        import gzip
+        with gzip.open(tmpname, 'wb') as f:
+            tree.write(f, encoding='utf-8', xml_declaration=True)
+        size = os.path.getsize(tmpname)
+        os.rename(tmpname, filename)
+        total = self._sizes.get(self.directory)
+        if total is not None:
+            total = self._sizes[self.directory] = total + size
+        if total is None or total > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """List the directory, and if its entries are over max_size remove the least recently used down to low_water"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError: # removed by someone else
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        if total > self.max_size:
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_size * self.low_water: break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+                total -= size
+        self._sizes[self.directory] = total
+
+# Cleanup for the rows of one kind of table, compiled once at import:
+# renames first, then for each field its (pattern, replacement template, {new field: group}) rules, in order.
+class CleanupRules(object):
+    def __init__(self, rename = None, fields = ()):
+        self.rename = sorted((rename or dict()).items())
+        self.fields = []
+        for field, rules in fields:
+            compiled = [(re.compile(pattern), template, sorted(groups.items())) for pattern, template, groups in rules]
+            # one search over all of a field's patterns tells whether any rule can apply, which most values fail
+            combined = re.compile('|'.join('(?:%s)' % pattern for pattern, template, groups in rules))
+            self.fields.append((field, combined, compiled))
+
+    def __call__(self, rows):
+        """Clean up a batch of row dicts in place"""
+        rename, fields = self.rename, self.fields
+        for item in rows:
+            for src, dst in rename:
+                if src in item:
+                    item[dst] = item.pop(src)
+            for key, combined, rules in fields:
+                if key not in item:
+                    continue
+                value = item[key]
+                if combined.search(value):
+                    for regex, template, groups in rules:
+                        match = regex.search(value)
+                        if match:
+                            value = value[:match.start()] + match.expand(template) + value[match.end():]
+                            for field, group in groups:
+                                item[field] = match.group(group)
+                if value:
+                    item[key] = value
+                else:
+                    del item[key]
+
+asset_cleanup = CleanupRules(
+    rename = {'Mutual funds, continued': 'Mutual funds'},
+    fields = [('Mutual funds', [(r'^Quote Symbol:\s*(\w+)$', '', {'Symbol': 1})])])
+
+# The tables of the Detail section, in the order they appear. The summary says which ones a statement has;
+# a new kind of activity only needs an entry here.
+ActivitySection = collections.namedtuple('ActivitySection', 'name title total cleanup')
+
+_delim = r'(?:\s*;\s*)?'
+activity_sections = [
+    ActivitySection('Deposits', 'Deposits and transfers in', 'Total deposits and transfers in', CleanupRules(
+        rename = {0: 'Description'},
+        fields = [('Description', [(r'^(ELECTRONIC TRANSFER FROM)\s*', '', {'Activity': 1})])])),
+    ActivitySection('Income', 'Income', 'Total income', CleanupRules(
+        rename = {0: 'Description'})),
+    ActivitySection('Purchases', 'Withdrawals to purchase securities', 'Total withdrawals to purchase securities', CleanupRules(
+        rename = {0: 'Description'},
+        fields = [('Description', [(r'^(REINVESTMENT INTO|SYSTEMATIC INVESTMENT PLAN)\s*', '', {'Activity': 1}),
+                                   (r'(\$[\d,]+)\s+BREAKPT' + _delim, '', {'BREAKPT': 1}),
+                                   (r'([\d.]+%)\s+CHRG' + _delim, '', {'Front Load': 1})])])),
+    #FIXME: Fees shares headers with Purchases (between the "Subtraction" and whatever comes next), it does't have its own
+    ActivitySection('Fees', 'Fees', 'Total fees', CleanupRules(
+        rename = {0: 'Description'})),
+]
+
+# Where a Statement's pages come from. A layout opens the document (returning its page count),
+# lays out pages one at a time in order, and builds a PageIndex for any page it has laid out.
+# For a page-parallel load, layout_pages() lays out ranges of pages in worker processes instead,
+# and the layout's add_page() takes each page it returns, in order.
+
+# Through pdfquery: pdfminer's layout converted to an lxml tree (which LayoutCache can store)
+class PDFQueryLayout(object):
+    def __init__(self, filename, cache = None, pdf = None):
+        if pdf is None:
+            import pdfquery
+            pdf = pdfquery.PDFQuery(filename, parse_tree_cacher = cache)
+        self.pdf = pdf
+        self.cache = cache
+        self.pages = []
+
+    def open(self, lazy):
+        if lazy:
+            self._tree = None
+            # just the document root, pages are added by load_page; it's quick to build, so it's kept out of the
+            # layout cache (and its hit and miss counts, which then count pages)
+            from pdfquery.cache import DummyCache
+            cacher, self.pdf._parse_tree_cacher = self.pdf._parse_tree_cacher, DummyCache()
+            try:
+                self.pdf.load(None)
+            finally:
+                self.pdf._parse_tree_cacher = cacher
+            from pdfminer.pdftypes import resolve1
+            return resolve1(self.pdf.doc.catalog['Pages'])['Count']
+        self.pdf.load()
+        self._tree = self.pdf.tree.getroot().findall('LTPage')
+        return len(self._tree)
 
-        date_bbox = copy.copy(account_bbox).move(0,-account_bbox.height * 2).expand(5)
-        date = page.find('LTTextLineHorizontal:in_bbox("%s")' % (date_bbox))
+    def load_page(self, number, map):
+        if self._tree is not None:
+            page = self._tree[number]
+        else:
+            # get_tree(n) goes through the parse_tree_cacher, so each page is cached on its own
+            page = self.pdf.get_tree(number).getroot().find('LTPage')
+            self.pdf.tree.getroot().append(page)
+        self.pages.append(page)
+        with profiler.stage('document_map'):
+            map.add_page(number, page)
 
-        date_matches = re.search(r'^\s*(.+?)\s*-\s*(.+?)\s*$',unpretty(date.text()))
-        self.endDate = datetime.datetime.strptime(date_matches.group(2),'%B %d, %Y')
-        self.startDate = datetime.datetime.strptime(date_matches.group(1),'%B %d').replace(year = statement.endDate.year)
+    @staticmethod
+    def layout_pages(filename, numbers, cache = None):
+        import pdfquery
+        from lxml import etree
+        pdf = pdfquery.PDFQuery(filename, parse_tree_cacher = cache)
+        return [etree.tostring(pdf.get_tree(number).getroot().find('LTPage')) for number in numbers]
+
+    def add_page(self, number, page, map):
+        """Add a page serialized by layout_pages() (after open(lazy = True))"""
+        from lxml import etree
+        page = etree.fromstring(page)
+        self.pdf.tree.getroot().append(page)
+        self.pages.append(page)
+        with profiler.stage('document_map'):
+            map.add_page(number, page)
+
+    def index(self, number):
+        return PageIndex.from_element(self.pages[number])
+
+    def release(self, number):
+        """Drop a page's layout, taking it out of the tree"""
+        # pdfquery holds on to every element it has built (and the pdfminer object behind each, down to the
+        # characters) so their .layout survives; nothing here uses that, and it's most of the memory
+        elements = getattr(self.pdf, '_elements', None)
+        if elements:
+            del elements[:]
+        page = self.pages[number]
+        if page is not None:
+            if page.getparent() is not None:
+                page.getparent().remove(page)
+            page.clear()
+            self.pages[number] = None
+            if self._tree is not None:
+                self._tree[number] = None
+
+# Straight from pdfminer's layout objects into PageIndexes, without building (and re-parsing) an lxml tree.
+# Uses the same layout parameters as pdfquery; there's no layout cache for this one.
+class PDFMinerLayout(object):
+    def __init__(self, filename):
+        from pdfminer.pdfparser import PDFParser
+        from pdfminer.pdfdocument import PDFDocument
+        from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+        from pdfminer.converter import PDFPageAggregator
+        from pdfminer.layout import LAParams
+        self.file = open(filename, 'rb')
+        self.doc = PDFDocument(PDFParser(self.file))
+        resources = PDFResourceManager()
+        self.device = PDFPageAggregator(resources, laparams = LAParams(all_texts = True, detect_vertical = True))
+        self.interpreter = PDFPageInterpreter(resources, self.device)
+        self.pages = []
+
+    def open(self, lazy):
+        from pdfminer.pdfpage import PDFPage
+        from pdfminer.pdftypes import resolve1
+        self._pdfpages = PDFPage.create_pages(self.doc)
+        return resolve1(self.doc.catalog['Pages'])['Count']
+
+    def layout_page(self, pdfpage, number):
+        self.interpreter.process_page(pdfpage)
+        return PageIndex.from_layout(self.device.get_result(), number)
+
+    def load_page(self, number, map):
+        self.add_page(number, self.layout_page(next(self._pdfpages), number), map)
 
-        self.tables()
+    @staticmethod
+    def layout_pages(filename, numbers, cache = None):
+        from pdfminer.pdfpage import PDFPage
+        layout = PDFMinerLayout(filename)
+        pdfpages = itertools.islice(PDFPage.create_pages(layout.doc), numbers[0], numbers[-1] + 1)
+        return [layout.layout_page(pdfpage, number) for number, pdfpage in zip(numbers, pdfpages)]
+
+    def add_page(self, number, index, map):
+        self.pages.append(index)
+        with profiler.stage('document_map'):
+            map.add_index(index)
+
+    def index(self, number):
+        return self.pages[number]
+
+    def release(self, number):
+        self.pages[number] = None
+
+layouts = {'pdfquery': PDFQueryLayout, 'pdfminer': PDFMinerLayout}
+
+def layout_pages(backend, filename, numbers, cache_dir = None, cache_size = None):
+    """Lay out a consecutive run of page numbers in a worker process, for Statement.load_pages_parallel().
+    Returns what the backend's add_page() takes for each page, plus the layout cache's hits and misses."""
+    cache = LayoutCache(cache_dir, cache_size) if cache_dir else None
+    pages = layouts[backend].layout_pages(filename, numbers, cache)
+    return pages, (cache.hits if cache else 0), (cache.misses if cache else 0)
+
+# One table row; page is the 0-based page index and row counts records within the statement
+Record = collections.namedtuple('Record', 'account section page row fields')
+
+class JSONLWriter(object):
+    def __init__(self, stream, header = True):
+        self.stream = stream
+
+    def write(self, record):
+        self.stream.write(json.dumps(record._asdict(), sort_keys = True) + '\n')
+
+# One line per cell, so every section fits the same columns
+class CSVWriter(object):
+    columns = ('account', 'section', 'page', 'row', 'field', 'value')
+
+    def __init__(self, stream, header = True):
+        import csv
+        self.writer = csv.writer(stream)
+        if header:
+            self.writer.writerow(self.columns)
+
+    def write(self, record):
+        for field, value in sorted(record.fields.items()):
+            self.writer.writerow([unicode(i).encode('utf8') for i in
+                                  (record.account, record.section, record.page, record.row, field, value)])
+
+writers = {'jsonl': JSONLWriter, 'csv': CSVWriter}
+
+def file_sha1(filename):
+    filehasher = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for data in iter(lambda: file.read(65536), ''):
+            filehasher.update(data)
+    return filehasher.hexdigest()
+
+# SQLite index of the statements already parsed (by this PARSER_VERSION), and what came out of them,
+# so a rerun over a growing archive only parses the new files.
+# A file counts as unchanged if its size and mtime match; if only the mtime moved, the content hash decides.
+# A file parsed without its tables (--no-tables) only counts as done for runs that don't want them either.
+class Manifest(object):
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS statements (
+                           path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, parser_version TEXT,
+                           account TEXT, start_date TEXT, end_date TEXT, pages INTEGER, records TEXT, tables INTEGER)''')
+        self.db.commit()
+
+    def unchanged(self, filename, tables = True):
+        """Whether filename was parsed (with its tables, if tables) by this PARSER_VERSION and hasn't changed since"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        row = self.db.execute('SELECT size, mtime, sha1, tables FROM statements WHERE path = ? AND parser_version = ?',
+                              (path, PARSER_VERSION)).fetchone()
+        if row is None or row[0] != st.st_size or (tables and not row[3]):
+            return False
+        if row[1] == st.st_mtime:
+            return True
+        if row[2] != file_sha1(path):
+            return False
+        with self.db:
+            self.db.execute('UPDATE statements SET mtime = ? WHERE path = ?', (st.st_mtime, path))
+        return True
+
+    def add(self, filename, result, tables = True):
+        """Record a parse_file result (after any os.utime, so the mtime stored is the one the next run sees),
+        and whether it was parsed with tables"""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO statements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (path, st.st_size, st.st_mtime, file_sha1(path), PARSER_VERSION,
+                             result['account'], result['startDate'].date().isoformat(), result['endDate'].date().isoformat(),
+                             result['pages'], json.dumps(result.get('records')), bool(tables)))
+
+    def records(self, filename):
+        row = self.db.execute('SELECT records FROM statements WHERE path = ?', (os.path.abspath(filename),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def close(self):
+        self.db.close()
+
+def parse_amount(text):
+    """'$1,234.56' (or '-$1,234.56', '−$1,234.56', '($1,234.56)') as a float, None if it isn't an amount"""
+    if not text:
+        return None
+    match = re.match(r'^\s*(\(|-)?\s*\$?([\d,]*\.?\d+)\)?\s*$', unpretty(text))
+    if not match:
+        return None
+    value = float(match.group(2).replace(',', ''))
+    return -value if match.group(1) else value
+
+# SQLite history across statements: every table row of every statement added, one row per statement period,
+# and each fund's running holdings and cost basis at the end of each period, so history is queried here
+# rather than by re-parsing the PDFs.
+#   periods:  one per (account, start, end); re-adding a period replaces its entries (unless the file is unchanged)
+#   entries:  the records, with date, symbol, amount, shares and price pulled out of their fields for indexing
+#   holdings: per (account, symbol, period): shares, price and value from the assets table, what was invested
+#             and paid out during the period, and the cost basis carried forward from the period before.
+# Cost basis is what went into a fund (purchases, including reinvested income); the Detail section has no sales.
+# Adding the latest period only touches that period's rows; adding one out of order also rolls the holdings of
+# that account's later periods forward from it.
+class Ledger(object):
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS periods (
+                id INTEGER PRIMARY KEY, account TEXT, start_date TEXT, end_date TEXT, path TEXT, sha1 TEXT,
+                parser_version TEXT, UNIQUE (account, start_date, end_date));
+            CREATE TABLE IF NOT EXISTS entries (
+                period INTEGER REFERENCES periods (id) ON DELETE CASCADE, account TEXT, section TEXT, row INTEGER,
+                date TEXT, symbol TEXT, activity TEXT, description TEXT, amount REAL, shares REAL, price REAL,
+                fields TEXT);
+            CREATE TABLE IF NOT EXISTS holdings (
+                period INTEGER REFERENCES periods (id) ON DELETE CASCADE, account TEXT, symbol TEXT, date TEXT,
+                fund TEXT, shares REAL, price REAL, value REAL, invested REAL, income REAL, cost_basis REAL,
+                PRIMARY KEY (account, symbol, period));
+            CREATE INDEX IF NOT EXISTS periods_account ON periods (account, end_date);
+            CREATE INDEX IF NOT EXISTS entries_period ON entries (period);
+            CREATE INDEX IF NOT EXISTS entries_account ON entries (account, date);
+            CREATE INDEX IF NOT EXISTS entries_symbol ON entries (symbol, date);
+            CREATE INDEX IF NOT EXISTS entries_section ON entries (section, date);
+            CREATE INDEX IF NOT EXISTS holdings_date ON holdings (account, date);''')
+        self.db.commit()
+
+    # pulled from an activity description: what the row's amount bought, and at what price
+    shares_pattern = re.compile(r'([\d,]*\.?\d+)\s+SHARES(?:\s+AT\s+(\$[\d,]*\.?\d+))?')
+
+    def add(self, filename, result):
+        """Record a parse_file result kept with keep_records. Returns False (changing nothing) if this
+        period is already in the ledger from the same file, or if the result has no records (tables = False),
+        True if it was added or replaced."""
+        if result.get('records') is None:
+            return False
+        path = os.path.abspath(filename)
+        sha1 = file_sha1(path)
+        account = result['account']
+        start, end = result['startDate'].date(), result['endDate'].date()
+        row = self.db.execute('SELECT id, sha1, parser_version FROM periods WHERE account = ? AND start_date = ? AND end_date = ?',
+                              (account, start.isoformat(), end.isoformat())).fetchone()
+        if row and row[1:] == (sha1, PARSER_VERSION):
+            return False
+        with self.db:
+            if row:
+                self.db.execute('DELETE FROM periods WHERE id = ?', (row[0],)) # and its entries and holdings
+            period = self.db.execute('INSERT INTO periods (account, start_date, end_date, path, sha1, parser_version) VALUES (?, ?, ?, ?, ?, ?)',
+                                     (account, start.isoformat(), end.isoformat(), path, sha1, PARSER_VERSION)).lastrowid
+            funds = self.funds(account)
+            entries = []
+            for record in result['records']:
+                fields = record['fields']
+                if record['section'] == 'Assets':
+                    funds[fields.get('Mutual funds', '')] = fields.get('Symbol')
+            for record in result['records']:
+                entries.append(self.entry(period, record, start, end, funds))
+            self.db.executemany('INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', entries)
+            self.roll_forward(account, end.isoformat())
+        return True
+
+    def entry(self, period, record, start, end, funds):
+        """The entries row for one record"""
+        fields = record['fields']
+        description = fields.get('Description') or fields.get('Mutual funds')
+        shares = price = None
+        if record['section'] == 'Assets':
+            date, symbol = end, fields.get('Symbol')
+            amount, shares, price = parse_amount(fields.get('Value')), parse_amount(fields.get('Quantity')), parse_amount(fields.get('Price'))
+        else:
+            date = self.row_date(fields.get('Date'), end)
+            symbol = self.symbol(description, funds)
+            amount = parse_amount(fields.get('Amount'))
+            match = self.shares_pattern.search(description or '')
+            if match:
+                shares, price = parse_amount(match.group(1)), parse_amount(match.group(2))
+        return (period, record['account'], record['section'], record['row'], date.isoformat(), symbol,
+                fields.get('Activity'), description, amount, shares, price, json.dumps(fields, sort_keys = True))
 
     @staticmethod
-    def page_content(page):
-        page_bbox = BBox(page)
-        header = page.find('LTFigure:overlaps_bbox("%s")' % (BBox(x=page_bbox.x, top=page_bbox.top, height=18)))
-        footer = page.find('LTFigure:overlaps_bbox("%s")' % (BBox(x=page_bbox.x, bottom=page_bbox.bottom, height=18)))
-        content_bbox = BBox(x=page_bbox.x, top = BBox(header).bottom, bottom = BBox(footer).top)
-#       content = page.find(':in_bbox("%s")' % (content_bbox))
-#        for i in content:
-#            print etree.tostring(i, pretty_print=True).encode('utf8')
+    def row_date(text, end):
+        """A row's 'MM/DD' as a date in the period ending end (which can run across the new year),
+        or end itself if text isn't one"""
+        match = re.match(r'^\s*(\d{1,2})/(\d{1,2})\s*$', text or '')
+        if match:
+            month, day = int(match.group(1)), int(match.group(2))
+            for year in (end.year, end.year - 1):
+                try:
+                    date = datetime.date(year, month, day)
+                except ValueError: # not a date that year (or at all)
+                    continue
+                if date <= end:
+                    return date
+        return end
 
-        return content_bbox
+    @staticmethod
+    def symbol(description, funds):
+        """The symbol of the (longest named) fund the description mentions, if any"""
+        if not description:
+            return None
+        names = [name for name in funds if name and name in description]
+        return funds[max(names, key = len)] if names else None
+
+    def funds(self, account):
+        """Fund name to symbol for the account, as its assets tables have given them so far"""
+        return dict(self.db.execute('SELECT DISTINCT fund, symbol FROM holdings WHERE account = ? AND fund IS NOT NULL', (account,)))
+
+    def roll_forward(self, account, end_date):
+        """(Re)compute the holdings of the account's period ending end_date and of any periods after it,
+        each carrying cost basis on from the one before. Runs inside add()'s transaction."""
+        periods = self.db.execute('SELECT id, end_date FROM periods WHERE account = ? AND end_date >= ? ORDER BY end_date',
+                                  (account, end_date)).fetchall()
+        basis = dict(self.db.execute('''SELECT symbol, cost_basis FROM holdings WHERE account = ? AND date =
+                                        (SELECT MAX(end_date) FROM periods WHERE account = ? AND end_date < ?)''',
+                                     (account, account, end_date)))
+        for period, date in periods:
+            holdings = dict()
+            for symbol, fund, shares, price, value in self.db.execute(
+                    "SELECT symbol, description, shares, price, amount FROM entries WHERE period = ? AND section = 'Assets' AND symbol IS NOT NULL",
+                    (period,)):
+                holdings[symbol] = dict(fund = fund, shares = shares, price = price, value = value, invested = 0.0, income = 0.0)
+            for symbol, section, amount in self.db.execute(
+                    "SELECT symbol, section, SUM(amount) FROM entries WHERE period = ? AND section IN ('Purchases', 'Income') AND symbol IS NOT NULL GROUP BY symbol, section",
+                    (period,)):
+                holding = holdings.setdefault(symbol, dict(fund = None, shares = None, price = None, value = None, invested = 0.0, income = 0.0))
+                holding['invested' if section == 'Purchases' else 'income'] = amount or 0.0
+            for symbol in basis:
+                holdings.setdefault(symbol, dict(fund = None, shares = 0.0, price = None, value = 0.0, invested = 0.0, income = 0.0))
+            self.db.execute('DELETE FROM holdings WHERE period = ?', (period,))
+            for symbol, holding in holdings.items():
+                basis[symbol] = basis.get(symbol, 0.0) + holding['invested']
+                self.db.execute('INSERT INTO holdings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (period, account, symbol, date, holding['fund'], holding['shares'], holding['price'],
+                                 holding['value'], holding['invested'], holding['income'], basis[symbol]))
+
+    def entries(self, account = None, symbol = None, section = None, activity = None, since = None, until = None):
+        """The entries matching every filter given (dates as ISO strings or dates, inclusive), oldest first, as dicts"""
+        where, params = self._filters(account = account, symbol = symbol, section = section, activity = activity,
+                                      since = since, until = until)
+        cursor = self.db.execute('SELECT account, section, row, date, symbol, activity, description, amount, shares, price, fields '
+                                 'FROM entries %s ORDER BY date, account, row' % (where), params)
+        columns = [i[0] for i in cursor.description]
+        for row in cursor:
+            entry = dict(zip(columns, row))
+            entry['fields'] = json.loads(entry['fields'])
+            yield entry
+
+    def holdings(self, account = None, symbol = None, since = None, until = None):
+        """Holdings at the end of each period in the range, oldest first, as dicts"""
+        where, params = self._filters(account = account, symbol = symbol, since = since, until = until)
+        cursor = self.db.execute('SELECT account, symbol, date, fund, shares, price, value, invested, income, cost_basis '
+                                 'FROM holdings %s ORDER BY date, account, symbol' % (where), params)
+        columns = [i[0] for i in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
 
     @staticmethod
-    def gridline_span(item):
-        page = item.parent('LTPage')
-        item_bbox = BBox(item)
-        lines = page.find('LTCurve:overlaps_bbox("%s")' % (BBox(x=item_bbox.x, y=page)))
-        gutters = [BBox(line).y for line in lines.items()]
-        below = max(i for i in gutters if i < item_bbox.y)
-        above = min(i for i in gutters if i > item_bbox.y)
-        return Span(below.max if below is not None else item_bbox.bottom,
-                    above.min if above is not None else item_bbox.top)
-
-    def tables(self):
-
-        def cleanup_regex(item, fields):
-            for key,rules in fields.items():
-                if key in item:
-                    value = item[key]
-                    for regex, template, func in rules:
-                        match = regex.search(value)
-                        if match:
-                            value = value[:match.start()] + match.expand(template) + value[match.end():]
-                            if func:
-                                item.update(func(match))
-
-                    if value:
-                        item[key] = value
-                    else:
-                        del item[key]
-        def cleanup_rename(item, mapping):
-            for src,dst in mapping.items():
-                if src in item:
-                    item[dst] = item.pop(src)
+    def _filters(**filters):
+        clauses, params = [], []
+        for name, value in sorted(filters.items()):
+            if value is None:
+                continue
+            clauses.append({'since': 'date >= ?', 'until': 'date <= ?'}.get(name, '%s = ?' % (name)))
+            params.append(value.isoformat() if isinstance(value, datetime.date) else value)
+        return ('WHERE ' + ' AND '.join(clauses) if clauses else ''), params
 
-        assets = self.pdf.pq('LTTextLineHorizontal:contains("Your Assets at Edward Jones")')
-        if assets:
-            assets_data = []
-            for page in page_range(assets):
-                content_bbox = Statement.page_content(page)
-                total_assets = page.find('LTTextLineHorizontal:contains("Total estimated asset value")')
+    def close(self):
+        self.db.close()
 
-                if page[0] is assets.parent('LTPage')[0]:
-                    content_bbox.top = BBox(assets).bottom
-                if total_assets:
-                    content_bbox.bottom = BBox(total_assets).top
+class Statement(object):
+    # With lazy = True, load() only lays out the first page; later pages are laid out as
+    # the anchor searches and page_ranges reach them, instead of all up front.
+    # backend picks one of the layouts above; pdf can supply an already constructed PDFQuery for the pdfquery one
+    # (or anything with the same load/tree, such as a synthetic layout).
+    # jobs > 1 lays the pages out in that many worker processes when loading eagerly, each taking runs of pages.
+    # stream = True (which implies lazy) also drops each page's layout once the parse has moved past it, so memory
+    # doesn't grow with the length of the statement; the parse only ever moves forward through the pages.
+    def __init__(self, filename, cache = None, lazy = False, pdf = None, backend = 'pdfquery', jobs = 1, stream = False):
+        self.filename = filename
+        self.backend = backend
+        self.cache = cache
+        if backend == 'pdfquery':
+            self.layout = PDFQueryLayout(filename, cache, pdf)
+        else:
+            self.layout = layouts[backend](filename)
+        self.lazy = lazy or stream
+        self.stream = stream
+        self.jobs = jobs
+        self.page_count = self.pages_loaded = 0
+        self.pages_released = 0 # pages before this one have been dropped
+        self._page_indexes = dict()
+        self.map = DocumentMap(self.anchors)
+
+    # every text the parse navigates by, see DocumentMap
+    anchors = ('Account number:', 'Your Assets at Edward Jones', 'Total estimated asset value', 'Mutual funds',
+               'Summary of Your Investment Activity', 'Detail of Your Investment Activity') + \
+              tuple(itertools.chain.from_iterable((i.title, i.total) for i in activity_sections))
+
+    @profiler.timed('layout')
+    def load_pages(self, count):
+        """Make sure the first count pages are laid out"""
+        while self.pages_loaded < min(count, self.page_count):
+            self.layout.load_page(self.pages_loaded, self.map)
+            self.pages_loaded += 1
+
+    @profiler.timed('layout')
+    def load_pages_parallel(self):
+        """Lay out all the pages in a pool of self.jobs worker processes, a run of pages per task, adding them in order"""
+        # a few runs per worker, so one slow run doesn't leave the others idle at the end
+        size = max(1, -(-self.page_count // (self.jobs * 4)))
+        runs = [range(begin, min(begin + size, self.page_count)) for begin in range(0, self.page_count, size)]
+        task = functools.partial(layout_pages, self.backend, self.filename,
+                                 cache_dir = self.cache.directory if self.cache else None,
+                                 cache_size = self.cache.max_size if self.cache else None)
+        import multiprocessing
+        pool = multiprocessing.Pool(min(self.jobs, len(runs)) or 1)
+        try:
+            # imap hands the runs back in order, so pages are added in order as they arrive
+            for pages, hits, misses in pool.imap(task, runs):
+                for page in pages:
+                    self.layout.add_page(self.pages_loaded, page, self.map)
+                    self.pages_loaded += 1
+                if self.cache:
+                    self.cache.hits += hits
+                    self.cache.misses += misses
+        finally:
+            pool.close()
+            pool.join()
+
+    def has_page(self, number):
+        self.load_pages(number + 1)
+        return number < self.pages_loaded
+
+    def anchor(self, text, page = 0, inside = None):
+        """DocumentMap.next(), laying out more pages until it finds something (or the document runs out)"""
+        found = self.map.next(text, page, inside)
+        while found is None and self.pages_loaded < self.page_count:
+            self.load_pages(self.pages_loaded + 1)
+            found = self.map.next(text, page, inside)
+        return found
+
+    def page_range(self, begin, **attrfuncs):
+        return page_range(begin, pages = self.reach_page, **attrfuncs)
+
+    def reach_page(self, number):
+        """has_page(), for a page_range moving on to page number; when streaming, the pages before it are done with"""
+        if self.stream:
+            self.release_pages(number)
+        return self.has_page(number)
+
+    def release_pages(self, end):
+        """Drop the layout of every page before page number end"""
+        for number in range(self.pages_released, min(end, self.pages_loaded)):
+            self._page_indexes.pop(number, None)
+            self.layout.release(number)
+            self.pages_released = number + 1
+
+    def page_index(self, number):
+        if number < self.pages_released:
+            raise ValueError("page %d of %s was already released" % (number, self.filename))
+        if number not in self._page_indexes:
+            with profiler.stage('page_index'):
+                self._page_indexes[number] = self.layout.index(number)
+        return self._page_indexes[number]
+
+    def load(self, tables = True):
+        """Read the account number and statement period, then (unless tables is False) the tables"""
+        parallel = self.jobs > 1 and not self.lazy
+        with profiler.stage('layout'):
+            self.page_count = self.layout.open(self.lazy or parallel)
+        if parallel:
+            self.load_pages_parallel()
+        else:
+            self.load_pages(1 if self.lazy else self.page_count)
+
+        with profiler.stage('header'):
+            self.header()
+
+        if tables:
+            self.tables()
+
+    def header(self):
+        """Read the account number and statement period from the first page"""
+        number, account = self.anchor('Account number:', inside = BBox(left = 0, bottom = 522, right = 288, top = 612))
+        account_bbox = account.bbox
+        self.account = re.search(r'Account number:\s*([\d-]*)',unpretty(account.text)).group(0)
 
-                header = page.find('LTTextLineHorizontal:contains("Mutual funds"):in_bbox("%s")' % (BBox(left = content_bbox.left, width=200, y = content_bbox.y)))
-                header_y = self.gridline_span(header)
-                content_bbox.top = header_y.min
+        date_bbox = account_bbox.copy().move(0,-account_bbox.height * 2).expand(5)
+        date = self.page_index(number).find('LTTextLineHorizontal', inside = date_bbox)
 
-                def cleanup_assets(item):
-                    cleanup_rename(item, {'Mutual funds, continued': 'Mutual funds'})
+        date_matches = re.search(r'^\s*(.+?)\s*-\s*(.+?)\s*$',unpretty(' '.join(i.text for i in date)))
+        self.endDate = datetime.datetime.strptime(date_matches.group(2),'%B %d, %Y')
+        self.startDate = datetime.datetime.strptime(date_matches.group(1),'%B %d').replace(year = self.endDate.year)
 
-                    cleanup_regex(item, {
-                    'Mutual funds':[
-                        (re.compile(r'^Quote Symbol:\s*(\w+)$'), '', lambda m: [('Symbol',m.group(1))])
-                    ]})
+    @staticmethod
+    @profiler.timed('page_content')
+    def page_content(index):
+        def discover():
+            page_bbox = index.bbox
+            header = index.find('LTFigure', overlaps = BBox(x=page_bbox.x, top=page_bbox.top, height=18))
+            footer = index.find('LTFigure', overlaps = BBox(x=page_bbox.x, bottom=page_bbox.bottom, height=18))
+            content_bbox = BBox(x=page_bbox.x.copy(), top = header[0].bbox.bottom, bottom = footer[0].bbox.top)
+#           content = page.find(':in_bbox("%s")' % (content_bbox))
+#            for i in content:
+#                print etree.tostring(i, pretty_print=True).encode('utf8')
+            return None, content_bbox
+
+        # the fingerprint is the page size and figures, which is all this depends on
+        return layout_templates.recall(index, 'page_content', discover, lambda evidence: True).copy()
 
-                assets_data += self.parse_table(page, content_bbox, header_y.size, cleanup_assets)
+    @staticmethod
+    @profiler.timed('gridline_span')
+    def gridline_span(index, item_bbox):
+        """The band between the gridlines just below and just above an item"""
+        def discover():
+            lines = index.find('LTCurve', overlaps = BBox(x=item_bbox.x, y=index.bbox.y))
+            below = max((line for line in lines if line.bbox.y < item_bbox.y), key = lambda line: line.bbox.y)
+            above = min((line for line in lines if line.bbox.y > item_bbox.y), key = lambda line: line.bbox.y)
+            # any other curve reaching between them has its bottom edge no lower than this
+            lowest = below.bbox.bottom - index.tallest('LTCurve')
+            evidence = (below.bbox.bounds(), above.bbox.bounds(), lowest, index.tallest('LTCurve'),
+                        index.count('LTCurve', lowest, above.bbox.bottom))
+            return evidence, Span(below.bbox.y.max, above.bbox.y.min)
+
+        def check(evidence):
+            below, above, lowest, tallest, count = evidence
+            return index.tallest('LTCurve') <= tallest and index.count('LTCurve', lowest, above[1]) == count and \
+                   bool(index.at('LTCurve', below)) and bool(index.at('LTCurve', above))
+
+        return layout_templates.recall(index, ('gridline_span', item_bbox.bounds()), discover, check)
+
+    # headings tables() prints when a section's records start
+    section_titles = {'Assets': 'Assets', 'Income': 'Income', 'Purchases': 'Purchase', 'Fees': 'Fees'}
+
+    def tables(self, records = None):
+        section = None
+        for record in (self.iter_records() if records is None else records):
+            if record.section != section:
+                section = record.section
+                if section in self.section_titles:
+                    print self.section_titles[section]
+            print record.fields
+
+    def iter_records(self):
+        """Generate a Record for each table row, a page at a time, as the tables are parsed"""
+        row = itertools.count()
+        def records(section, page, rows):
+            profiler.count(page, 'rows emitted', len(rows))
+            for fields in rows:
+                yield Record(self.account, section, page, next(row), fields)
+
+        assets = self.anchor("Your Assets at Edward Jones")
+        if assets:
+            assets_page, assets = assets
+            for page in self.page_range(assets_page):
+                with profiler.stage('assets'):
+                    index = self.page_index(page)
+                    content_bbox = Statement.page_content(index)
+                    total_assets = self.map.find("Total estimated asset value", page)
+
+                    if page == assets_page:
+                        content_bbox.top = assets.bbox.bottom
+                    if total_assets:
+                        content_bbox.bottom = total_assets[0].bbox.top
+
+                    header = self.map.find("Mutual funds", page, inside = BBox(left = content_bbox.left, width=200, y = content_bbox.y))
+                    header_y = self.gridline_span(index, header[0].bbox)
+                    content_bbox.top = header_y.min
+
+                    rows = self.parse_table(index, content_bbox, header_y.size, asset_cleanup)
+                for record in records('Assets', page, rows):
+                    yield record
                 # found the end, so now we're done
                 if total_assets: break
 
-        print "Assets"
-        for asset in assets_data:
-            print asset
+        sections = self.summary_sections()
 
+        detail_page, detail = self.anchor("Detail of Your Investment Activity")
+        detail_pages = self.page_range(detail_page, index=self.page_index, content_bbox=lambda page: Statement.page_content(self.page_index(page)))
+
+        next(detail_pages)
+        detail_pages.content_bbox.top = detail.bbox.bottom
+        
+        for section in activity_sections:
+            if section.name in sections:
+                for page, rows in self.table_data(detail_pages, section.title, section.total, section.cleanup):
+                    for record in records(section.name, page, rows):
+                        yield record
+
+        if self.stream:
+            self.release_pages(self.pages_loaded)
+
+    @profiler.timed('summary')
+    def summary_sections(self):
+        """Which activity sections the summary lists, so only those get looked for in the detail"""
         sections = set()
 
-        summary = self.pdf.pq('LTTextLineHorizontal:contains("Summary of Your Investment Activity")')
-        summary_pages = page_range(summary, content_bbox=lambda page: Statement.page_content(page))
+        summary_page, summary = self.anchor("Summary of Your Investment Activity")
+        summary_pages = self.page_range(summary_page, index=self.page_index, content_bbox=lambda page: Statement.page_content(self.page_index(page)))
 
         next(summary_pages)
-        summary_pages.content_bbox.top = BBox(summary).bottom
+        summary_pages.content_bbox.top = summary.bbox.bottom
 
-        while summary_pages.page:
-            detail = summary_pages.page.find('LTTextLineHorizontal:contains("Detail of Your Investment Activity")')
+        while summary_pages.page is not None:
+            number = summary_pages.page
+            detail = self.map.find("Detail of Your Investment Activity", number)
             if detail:
-                summary_pages.content_bbox.bottom = BBox(detail).top
+                summary_pages.content_bbox.bottom = detail[0].bbox.top
                 
-            if summary_pages.page.find('LTTextLineHorizontal:in_bbox("%s"):contains("Deposits and transfers in")' % (summary_pages.content_bbox)):
-                sections.add("Deposits")
-            if summary_pages.page.find('LTTextLineHorizontal:in_bbox("%s"):contains("Income")' % (summary_pages.content_bbox)):
-                sections.add("Income")            
-            if summary_pages.page.find('LTTextLineHorizontal:in_bbox("%s"):contains("Withdrawals to purchase securities")' % (summary_pages.content_bbox)):
-                sections.add("Purchases")
-            if summary_pages.page.find('LTTextLineHorizontal:in_bbox("%s"):contains("Fees")' % (summary_pages.content_bbox)):
-                sections.add("Fees")            
+            for section in activity_sections:
+                if self.map.find(section.title, number, inside = summary_pages.content_bbox):
+                    sections.add(section.name)
            
 
             if detail:
                 break
             else:
                 next(summary_pages)
-        
-
-        detail = self.pdf.pq('LTTextLineHorizontal:contains("Detail of Your Investment Activity")')
-        detail_pages = page_range(detail, content_bbox=lambda page: Statement.page_content(page))
-
-        next(detail_pages)
-        detail_pages.content_bbox.top = BBox(detail).bottom
-        
-        if "Deposits" in sections:
-            def cleanup_deposits(item):
-                 cleanup_rename(item, {0:'Description'})
-                 cleanup_regex(item,{
-                    'Description': [
-                        (re.compile('^(ELECTRONIC TRANSFER FROM)\s*'),'', lambda m: [('Activity',m.group(1))])
-                    ]})
-            deposits_data = self.table_data(detail_pages,'Deposits and transfers in','Total deposits and transfers in', cleanup_deposits)
-            for deposit in deposits_data:
-                print deposit
-
-        if "Income" in sections: # income is not always present, see if it's even in the document at all
-            print "Income"
-            
-            def cleanup_income(item):
-                cleanup_rename(item, {0:'Description'})
-                
-            income_data = self.table_data(detail_pages,'Income','Total income', cleanup_income)
-            for income in income_data:
-                print income
-
-
-        if "Purchases" in sections:
-            print "Purchase"
-
-            def cleanup_purchase(item):
-                cleanup_rename(item, {0:'Description'})
-                
-                delim = r'(?:\s*;\s*)?'
-                cleanup_regex(item,{
-                    'Description': [
-                        (re.compile(r'^(REINVESTMENT INTO|SYSTEMATIC INVESTMENT PLAN)\s*'),'', lambda m: [('Activity',m.group(1))]),
-                        (re.compile(r'(\$[\d,]+)\s+BREAKPT' + delim),'', lambda m: [('BREAKPT',m.group(1))]),
-                        (re.compile(r'([\d.]+%)\s+CHRG' + delim),'', lambda m: [('Front Load',m.group(1))])
-                    ]})
-
-            purchase_data = self.table_data(detail_pages, 'Withdrawals to purchase securities','Total withdrawals to purchase securities', cleanup_purchase)
-
-            for purchase in purchase_data:
-                print purchase
-
-        #FIXME: Fees shares headers with Purchases (between the "Subtraction" and whatever comes next), it does't have its own
-        if "Fees" in sections:
-            print "Fees"
-
-            def cleanup_fees(item):
-                cleanup_rename(item, {0:'Description'})
-            
-            fee_data = self.table_data(detail_pages, 'Fees','Total fees', cleanup_fees)
-
-            for fee in fee_data:
-                print fee
-    @staticmethod
-    def table_data(page_range, title_text, total_text, cleanup = None):
-        data = []
-        while page_range.page:
-            title = page_range.page.find('LTTextLineHorizontal:in_bbox("%s"):contains("%s")' % (page_range.content_bbox, title_text))
-            if not title: # keep searching on the next page
-                next(page_range)
+        return sections
+
+    def table_data(self, page_range, title_text, total_text, cleanup = None):
+        """Generate (page, rows) for each page of a table, until its total line"""
+        while page_range.page is not None:
+            with profiler.stage('table_data'):
+                number = page_range.page
+                title = self.map.find(title_text, number, inside = page_range.content_bbox)
+                if title:
+                    title_bbox = title[0].bbox
+
+                    cell_bbox = BBox(left = title_bbox.right, right = page_range.content_bbox.right, top = title_bbox.top, bottom = page_range.content_bbox.bottom)
+
+                    total = self.map.find(total_text, number, inside = page_range.content_bbox)
+                    if total:
+                        cell_bbox.bottom = total[0].bbox.top
+
+                    line = page_range.index.find('LTCurve', overlaps = BBox(x = title_bbox.x, bottom = title_bbox.top, height = 8))
+                    if line:
+                        cell_bbox.top = line[0].bbox.bottom
+            if not title: # skip straight to the next page that has one
+                following = self.anchor(title_text, number + 1)
+                if following is None:
+                    break
+                page_range.seek(following[0])
                 continue
-            
-            title_bbox = BBox(title)
-            
-            cell_bbox = BBox(left = title_bbox.right, right = page_range.content_bbox.right, top = title_bbox.top, bottom = page_range.content_bbox.bottom)
-
-            total = page_range.page.find('LTTextLineHorizontal:in_bbox("%s"):contains("%s")' % (page_range.content_bbox, total_text))
-            if total:
-                cell_bbox.bottom = BBox(total).top
 
-            line = page_range.page.find('LTCurve:overlaps_bbox("%s")' % (BBox(x = title_bbox.x, bottom = title_bbox.top, height = 8)))
-            if line:
-                cell_bbox.top = BBox(line).bottom
-
-            data += Statement.parse_table(page_range.page, cell_bbox, 3*title_bbox.height, cleanup)
+            yield page_range.page, Statement.parse_table(page_range.index, cell_bbox, 3*title_bbox.height, cleanup)
 
             # found the end, so mark what we consumed and return
             if total:
@@ -417,77 +1499,95 @@ class Statement(object):
                 break;
             else:
                 next(page_range)
-        return data
 
     @staticmethod
-    def parse_table(page, cell_bbox, height=20, cleanup = None):
-        rows = Statement.parse_rows(page, cell_bbox, height=height)
+    def parse_table(index, cell_bbox, height=20, cleanup = None):
+        rows = Statement.parse_rows(index, cell_bbox, height=height)
         if cleanup:
-            for i in rows.values():
-                cleanup(i)
-        rows = Statement.merge_by_lines(rows, page, cell_bbox)
-        # PDF origin is *bottom*-left, so reverse the sort
-        return rows.values(sort = True, reverse = True)
+            with profiler.stage('cleanup'):
+                cleanup([data for span, data in rows])
+        # PDF origin is *bottom*-left, so merge_by_lines hands them back top down
+        return Statement.merge_by_lines(rows, index, cell_bbox)
 
-    #FIXME: merge_by_lines is still missing some merges...
     @staticmethod
-    def merge_by_lines(rows, page, cell_bbox):        
-        lines = page.find('LTCurve:overlaps_bbox("%s")' % (cell_bbox))
-
-        gutters = [BBox(line).y for line in lines.items()]
-        gutters.sort()
-                
-        multirows = SpanDictionary(merge_overlap = False)
-        for below,above in window_iterator(gutters,2):
-            span = Span(cell_bbox.bottom if below is None else below.max, cell_bbox.top if above is None else above.min)
-            multirows[span].update(dict())
-
-        for span, data in rows.items(reverse=True):
-            target = multirows[span]
-            for key,value in data.items():
+    @profiler.timed('merge_by_lines')
+    def merge_by_lines(rows, index, cell_bbox):
+        """Merge the (span, data) rows lying between the same pair of gridlines into one dict per table row, top down.
+        Each row goes to the band its middle falls in, found by bisecting the sorted gridlines, so rows that
+        straddle or barely touch a band, or sit above the top gridline, still merge. Without gridlines, nothing merges."""
+        lines = index.find('LTCurve', overlaps = cell_bbox)
+        gutters = sorted((line.bbox.y.min + line.bbox.y.max) / 2 for line in lines)
+        if not gutters:
+            return [data for span, data in reversed(rows)]
+
+        bands = dict()
+        for span, data in reversed(rows):
+            target = bands.setdefault(bisect.bisect(gutters, (span.min + span.max) / 2), dict())
+            for key, value in data.items():
                 if key in target:
                     target[key] += '\n' + value
                 else:
                     target[key] = value
-                    
-        for span, data in multirows.items():
-            if not data:
-                del multirows[span]
-        return multirows
+        return [bands[band] for band in sorted(bands, reverse = True)]
 
     @staticmethod
-    def parse_rows(page, cell_bbox, height=20):
-        columns = SpanDictionary(merge_overlap = False)
-
-        # LTTextBoxHorizontal sometimes merges too much (across gridlines), but LTTextLineHorizontal doesn't merge multiline values
-        # So this has to be done manually anyway...
-        headers = page.find('LTTextLineHorizontal:in_bbox("%s")' % (BBox(x = cell_bbox.x, bottom = cell_bbox.top, height = height)))
-        for header in sorted(headers.items(), key = lambda x: BBox(x).y):
-            column = columns[BBox(header).x]
-            if 'title' in column:
-                column['title'] += '\n' + header.text()
-            else:
-                column['title'] = header.text()
-
-        #for i in headers:
-         #   print etree.tostring(i, pretty_print=True).encode('utf8')
-                    
-        rows = SpanDictionary(merge_overlap = True)
-
-        unknown_column = 0
-
-        cells = page.find('LTTextLineHorizontal:in_bbox("%s")' % (cell_bbox))
-        for cell in cells.items():
-            cell_bbox = BBox(cell)
-
-            if cell.text(): #TODO where are these LTTextLineHorizontal items with no text coming from?
-                row = rows[cell_bbox.y]
-                column = columns[cell_bbox.x]
-                if not 'title' in column:
-                    column['title'] = unknown_column
-                    unknown_column += 1
-                row[column['title']] = cell.text()
-
+    @profiler.timed('parse_rows')
+    def parse_rows(index, cell_bbox, height=20, overlap_size=1):
+        """The cells within cell_bbox as (row span, {column title: text}) in ascending order, with the columns
+        titled by the lines of text above cell_bbox (up to height) and numbered in order where there's no title.
+        Rows and columns are clustered from all the cells at once by sweep_spans; a column keeps the extent of its
+        leftmost title (or cell), so a wide cell can't chain neighbouring columns together.
+        Spans only count as overlapping by at least overlap_size, for titles and cells alike."""
+        # LTTextLineHorizontal doesn't merge multiline values (and LTTextBoxHorizontal merges too much, across gridlines),
+        # so the lines of a header or cell are put back together here
+        header_bbox = BBox(x = cell_bbox.x, bottom = cell_bbox.top, height = height)
+        header_bounds = rounded_bounds(header_bbox)
+        def discover():
+            headers = index.find('LTTextLineHorizontal', inside = header_bbox)
+            headers.sort(key = lambda i: i.bbox.y.min)
+            columns, labels = sweep_spans([i.bbox.x for i in headers], overlap_size, merge = False)
+            titles = [None] * len(columns)
+            for header, column in zip(headers, labels):
+                titles[column] = header.text if titles[column] is None else titles[column] + '\n' + header.text
+            # the headers, and how many text lines have their bottom edge in the band (which includes any header)
+            evidence = (tuple((i.bbox.bounds(), i.text) for i in headers),
+                        index.count('LTTextLineHorizontal', header_bounds[1], header_bounds[3]))
+            return evidence, (columns, titles, [i.min for i in columns], max([i.size for i in columns] or [0]))
+
+        def check(evidence):
+            headers, count = evidence
+            return index.count('LTTextLineHorizontal', header_bounds[1], header_bounds[3]) == count and \
+                   all(any(i.text == text for i in index.at('LTTextLineHorizontal', bounds)) for bounds, text in headers)
+
+        columns, titles, column_mins, widest = layout_templates.recall(index, ('columns', header_bounds), discover, check)
+
+        def titled_column(span):
+            # leftmost one overlapping span
+            lo = bisect.bisect_left(column_mins, span.min - widest)
+            hi = bisect.bisect_right(column_mins, span.max)
+            for column in range(lo, hi):
+                if span.overlaps(columns[column], overlap_size):
+                    return column
+            return None
+
+        #TODO where are these LTTextLineHorizontal items with no text coming from?
+        cells = [i for i in index.find('LTTextLineHorizontal', inside = cell_bbox) if i.text]
+        cell_columns = [titled_column(i.bbox.x) for i in cells]
+        cell_titles = [titles[column] if column is not None else None for column in cell_columns]
+
+        # cells under no title make up columns of their own, numbered in the order they first turn up
+        untitled = [n for n, column in enumerate(cell_columns) if column is None]
+        unknown_labels = sweep_spans([cells[n].bbox.x for n in untitled], overlap_size, merge = False)[1]
+        numbers = dict()
+        for n, label in zip(untitled, unknown_labels):
+            cell_titles[n] = numbers.setdefault(label, len(numbers))
+
+        spans, cell_rows = sweep_spans([i.bbox.y for i in cells], overlap_size)
+        rows = [(span, dict()) for span in spans]
+        # top down, so two lines of one cell that overlap enough to land in the same row still read in order
+        for n in sorted(range(len(cells)), key = lambda n: -cells[n].bbox.top):
+            row, title = rows[cell_rows[n]][1], cell_titles[n]
+            row[title] = cells[n].text if title not in row else row[title] + '\n' + cells[n].text
         return rows
         
     def __str__(self):
@@ -496,16 +1596,76 @@ class Statement(object):
 def unpretty(s):
     return s.replace(u'−','-')
 
-parser = argparse.ArgumentParser(description='Scan EJ Statement PDFs.')
-parser.add_argument('infiles', nargs='*')
-
-globbed_argv = itertools.chain.from_iterable(glob.iglob(x) for x in sys.argv[1:])
-args = parser.parse_args(globbed_argv)
-
-for file in args.infiles:
-    print "parsing %s" % (file)
-    statement = Statement(file)
-    statement.load()
-    timestamp = time.mktime(statement.endDate.utctimetuple())
-    os.utime(statement.filename, (timestamp,timestamp))
-    print statement
+def peak_rss(who = resource.RUSAGE_SELF):
+    """Peak resident set size in bytes, of this process or (RUSAGE_CHILDREN) the largest of its finished children"""
+    return resource.getrusage(who).ru_maxrss * 1024 # Linux reports KB
+
+def parse_file(filename, cache_dir = None, cache_size = None, lazy = False, tables = True, format = 'text', keep_records = False,
+               profile = False, profile_dir = None, backend = 'pdfquery', templates = True, page_jobs = 1, stream = False):
+    """Load one statement, suitable for running in a worker process.
+    Returns a summary (the Statement itself can't be pickled) with whatever load() printed,
+    or the records serialized by writers[format] if format isn't 'text', plus the records themselves
+    if keep_records is set, and the profiler report if profile is set (profile_dir also dumps cProfile stats there).
+    With templates, what's learned about the layout carries over to the next statement parsed in this process.
+    page_jobs > 1 lays out the statement's pages in that many processes (which a worker process can't start).
+    stream releases each page once it's parsed; the summary includes this process's peak RSS so far, in bytes.
+    Reports a failure as a traceback rather than raising, so one bad file doesn't abort a batch."""
+    import traceback
+    result = dict(filename = filename, output = '', error = None, pages = 0, cache_hits = 0, cache_misses = 0)
+    layout_templates.enabled = templates
+    template_hits, template_misses = layout_templates.hits, layout_templates.misses
+    cache = LayoutCache(cache_dir, cache_size) if cache_dir else None
+    profiler.enabled = profile or bool(profile_dir)
+    profiler.reset()
+    capture = None
+    if profile_dir:
+        import cProfile
+        capture = cProfile.Profile()
+    stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+    try:
+        if capture:
+            capture.enable()
+        with profiler.stage('total'):
+            result.update(parse_statement(filename, cache, lazy, tables, format, keep_records, backend, page_jobs, stream))
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        if capture:
+            capture.disable()
+        stdout, sys.stdout = sys.stdout, stdout
+        result['output'] = stdout.getvalue()
+    if cache:
+        result.update(cache_hits = cache.hits, cache_misses = cache.misses)
+    result.update(template_hits = layout_templates.hits - template_hits, template_misses = layout_templates.misses - template_misses)
+    result['peak_rss'] = peak_rss(resource.RUSAGE_SELF)
+    if profiler.enabled:
+        result['profile'] = profiler.report()
+    if capture:
+        capture.dump_stats(os.path.join(profile_dir, os.path.basename(filename) + '.prof'))
+    return result
+
+def parse_statement(filename, cache, lazy, tables, format, keep_records, backend = 'pdfquery', page_jobs = 1, stream = False):
+    """The part of parse_file that works with the Statement"""
+    result = dict()
+    statement = Statement(filename, cache, lazy = lazy, backend = backend, jobs = page_jobs, stream = stream)
+    statement.load(tables = False)
+    if tables:
+        records = statement.iter_records()
+        if keep_records:
+            records = list(records)
+            result['records'] = [record._asdict() for record in records]
+        if format == 'text':
+            statement.tables(records)
+        elif format is not None:
+            writer = writers[format](sys.stdout, header = False)
+            for record in records:
+                writer.write(record)
+        else: # just parse them, for keep_records
+            collections.deque(records, maxlen = 0)
+    result.update(statement = str(statement), account = statement.account,
+                  startDate = statement.startDate, endDate = statement.endDate, pages = statement.pages_loaded)
+    return result
+
+if __name__ == '__main__':
+    import statements_cli # the command line lives there now; this keeps `python statements.py ...` working
+    statements_cli.main()
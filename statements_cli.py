@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Command line for statements.py: parse EJ statement PDFs, serve parses on a Unix socket, or send files to a server.
+# usage: python statements_cli.py [options] infiles...   (or python statements.py, which runs this)
+import os
+import sys
+import glob
+import json
+import time
+import base64
+import argparse
+import functools
+import itertools
+import multiprocessing
+import resource
+
+from statements import layouts, writers, parse_file, Profiler, Manifest, Ledger, peak_rss
+from statements_server import serve, request_parse
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Scan EJ Statement PDFs.')
+    parser.add_argument('infiles', nargs='*')
+    parser.add_argument('--cache-dir', help='cache PDF layouts in this directory, so re-parsing an unchanged statement skips pdfminer')
+    parser.add_argument('--cache-size', type=int, default=512, metavar='MB', help='evict least recently used layouts beyond this size (default: %(default)s)')
+    parser.add_argument('--backend', choices=sorted(layouts), default='pdfquery',
+                        help='lay out pages through pdfquery\'s lxml tree, or straight from pdfminer (faster, but not cached)')
+    parser.add_argument('--no-templates', dest='templates', action='store_false',
+                        help='work out every page\'s structure from scratch, rather than checking it against pages seen before')
+    parser.add_argument('--stream', action='store_true',
+                        help='release each page once its tables are read, so memory stays flat however long the statement (implies --lazy)')
+    parser.add_argument('--lazy', action='store_true', help='lay out pages only as the parse reaches them')
+    parser.add_argument('--no-tables', dest='tables', action='store_false', help='only read the account number and statement period (implies --lazy)')
+    parser.add_argument('--format', choices=['text'] + sorted(writers), default='text',
+                        help='write table records as text, JSON lines or CSV on stdout (progress then goes to stderr)')
+    parser.add_argument('--manifest', metavar='DB', help='skip statements this SQLite manifest says are already parsed, and record new ones in it')
+    parser.add_argument('--force', action='store_true', help='re-parse statements even if the manifest has them')
+    parser.add_argument('--ledger', metavar='DB', help='add each statement parsed to this SQLite ledger of history across statements')
+    parser.add_argument('--history', choices=['entries', 'holdings'],
+                        help='instead of parsing, write the ledger\'s entries or holdings (filtered by the options below) as JSON lines')
+    parser.add_argument('--account', help='with --history, only this account (as in "Account number: 123-45678-1-2")')
+    parser.add_argument('--symbol', help='with --history, only this fund')
+    parser.add_argument('--section', help='with --history entries, only this section (Assets, Deposits, Income, Purchases, Fees)')
+    parser.add_argument('--activity', help='with --history entries, only this activity (such as "REINVESTMENT INTO")')
+    parser.add_argument('--since', metavar='YYYY-MM-DD', help='with --history, from this date')
+    parser.add_argument('--until', metavar='YYYY-MM-DD', help='with --history, up to this date')
+    parser.add_argument('--profile', action='store_true', help='report time per parse stage and counters per page, for each file and the whole run')
+    parser.add_argument('--profile-dump', metavar='DIR', help='also write cProfile stats for each file to DIR (implies --profile)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='parse N statements at a time in worker processes')
+    parser.add_argument('--page-jobs', type=int, default=1, metavar='N',
+                        help='lay out the pages of each statement in N worker processes, for one big statement (not with --jobs, --serve, --lazy, --stream or --no-tables)')
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='stay up parsing the statements sent to this Unix socket (at most --jobs at a time), replying with JSON')
+    parser.add_argument('--client', metavar='SOCKET', help='have the server on this Unix socket parse the infiles, writing its JSON replies on stdout')
+    parser.add_argument('--send-data', action='store_true', help='with --client, send the PDFs themselves rather than their paths')
+
+    args = parser.parse_args(argv)
+    args.infiles = list(itertools.chain.from_iterable(glob.iglob(x) for x in args.infiles))
+    if args.cache_dir and args.backend != 'pdfquery':
+        parser.error('--cache-dir only applies to the pdfquery backend')
+    if args.page_jobs > 1 and (args.jobs > 1 or args.serve):
+        parser.error('--page-jobs can\'t be combined with --jobs or --serve')
+    if args.page_jobs > 1 and (args.lazy or args.stream or not args.tables):
+        parser.error('--page-jobs lays out all the pages up front, it can\'t be combined with --lazy, --stream or --no-tables')
+    if args.manifest and (args.serve or args.client):
+        parser.error('--manifest can\'t be combined with --serve or --client')
+    if args.ledger and (args.serve or args.client):
+        parser.error('--ledger can\'t be combined with --serve or --client')
+    if args.ledger and not args.tables:
+        parser.error('--ledger needs the tables, it can\'t be combined with --no-tables')
+    if args.history and not args.ledger:
+        parser.error('--history needs --ledger')
+
+    if args.history:
+        ledger = Ledger(args.ledger)
+        filters = dict(account = args.account, symbol = args.symbol, since = args.since, until = args.until)
+        if args.history == 'entries':
+            rows = ledger.entries(section = args.section, activity = args.activity, **filters)
+        else:
+            rows = ledger.holdings(**filters)
+        for row in rows:
+            print json.dumps(row, sort_keys = True)
+        ledger.close()
+        sys.exit(0)
+
+    if args.serve:
+        print >>sys.stderr, "serving %s with %d workers" % (args.serve, args.jobs)
+        serve(args.serve, functools.partial(parse_file, cache_dir = args.cache_dir, cache_size = args.cache_size*1024*1024,
+                                            lazy = args.lazy or not args.tables, tables = args.tables, format = None,
+                                            keep_records = True, backend = args.backend, templates = args.templates,
+                                            stream = args.stream), args.jobs)
+        sys.exit(0)
+
+    if args.client:
+        def requests():
+            for filename in args.infiles:
+                if args.send_data:
+                    with open(filename, 'rb') as f:
+                        yield dict(data = base64.b64encode(f.read()), name = filename)
+                else:
+                    yield dict(path = os.path.abspath(filename))
+        failures = 0
+        for reply in request_parse(args.client, requests()):
+            print json.dumps(reply, sort_keys = True)
+            if reply.get('error'):
+                print >>sys.stderr, "error parsing %s:\n%s" % (reply.get('filename'), reply['error'])
+                failures += 1
+        sys.exit(1 if failures else 0)
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    ledger = Ledger(args.ledger) if args.ledger else None
+    added = 0
+    skipped = 0
+    if manifest and not args.force:
+        infiles = [i for i in args.infiles if not manifest.unchanged(i, args.tables)]
+        skipped = len(args.infiles) - len(infiles)
+        args.infiles = infiles
+
+    parse = functools.partial(parse_file, cache_dir = args.cache_dir, cache_size = args.cache_size*1024*1024,
+                              lazy = args.lazy or not args.tables, tables = args.tables, format = args.format,
+                              keep_records = manifest is not None or ledger is not None,
+                              profile = args.profile or bool(args.profile_dump), profile_dir = args.profile_dump,
+                              backend = args.backend, templates = args.templates, page_jobs = args.page_jobs,
+                              stream = args.stream)
+    if args.profile_dump and not os.path.isdir(args.profile_dump):
+        os.makedirs(args.profile_dump)
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    start = time.time()
+    files = pages = failures = cache_hits = cache_misses = template_hits = template_misses = 0
+    profile_total = dict(stages = dict(), pages = dict())
+    file_times = []
+
+    # keep stdout clean for the records when they're meant for another program
+    log = sys.stdout if args.format == 'text' else sys.stderr
+    if args.format != 'text':
+        writers[args.format](sys.stdout) # just the header, the workers write the records
+
+    # results come back in input order either way
+    for result in (pool.imap(parse, args.infiles) if pool else itertools.imap(parse, args.infiles)):
+        print >>log, "parsing %s" % (result['filename'])
+        # a failed parse's records stop partway through, so only text (for people) shows what it got
+        if args.format == 'text' or not result['error']:
+            sys.stdout.write(result['output'])
+            sys.stdout.flush()
+        cache_hits += result['cache_hits']
+        cache_misses += result['cache_misses']
+        template_hits += result['template_hits']
+        template_misses += result['template_misses']
+        if 'profile' in result:
+            print >>log, Profiler.format(result['profile'])
+            # pages are only comparable within a file, so the aggregate keeps just the stages
+            Profiler.merge(profile_total, dict(stages = result['profile']['stages'], pages = dict()))
+            file_times.append((result['profile']['stages'].get('total', [0, 0.0])[1], result['filename']))
+        if result['error']:
+            print >>sys.stderr, "error parsing %s:\n%s" % (result['filename'], result['error'])
+            failures += 1
+            continue
+        timestamp = time.mktime(result['endDate'].utctimetuple())
+        os.utime(result['filename'], (timestamp,timestamp))
+        print >>log, result['statement']
+        if manifest:
+            manifest.add(result['filename'], result, args.tables)
+        if ledger and ledger.add(result['filename'], result):
+            added += 1
+        files += 1
+        pages += result['pages']
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    elapsed = time.time() - start
+    print >>log, "parsed %d files (%d pages, %d failed) in %.2fs: %.2f files/sec, %.2f pages/sec" % (
+        files, pages, failures, elapsed, files/elapsed if elapsed else 0, pages/elapsed if elapsed else 0)
+    if file_times:
+        print >>log, "stages over all files:"
+        print >>log, Profiler.format(profile_total)
+        print >>log, "slowest files:"
+        for elapsed, filename in sorted(file_times, reverse = True)[:10]:
+            print >>log, "  %10.4f %s" % (elapsed, filename)
+    if manifest:
+        print >>log, "manifest %s: %d unchanged files skipped" % (args.manifest, skipped)
+        manifest.close()
+    if ledger:
+        print >>log, "ledger %s: %d statement periods added or replaced" % (args.ledger, added)
+        ledger.close()
+    if args.cache_dir:
+        print >>log, "layout cache %s: %d hits, %d misses" % (args.cache_dir, cache_hits, cache_misses)
+    print >>log, "peak memory: %.1f MB" % (max(peak_rss(resource.RUSAGE_SELF), peak_rss(resource.RUSAGE_CHILDREN)) / 1048576.0)
+    if args.templates:
+        print >>log, "layout templates: %d hits, %d misses" % (template_hits, template_misses)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import base64
+import socket
+import signal
+import datetime
+import tempfile
+import traceback
+import multiprocessing
+import SocketServer
+
+# A warm, long running parser, so a pipeline handing over one statement at a time doesn't pay for starting Python
+# and importing pdfquery and pdfminer each time. It listens on a Unix socket, reading one JSON request per line:
+#   {"path": "/absolute/path/to/statement.pdf"}
+#   {"data": "<the PDF, base64 encoded>", "name": "label for the reply"}
+# and answering each with one JSON line: parse_file's summary (filename, error, statement, account, startDate,
+# endDate, pages) plus the records, as JSONLWriter writes them.
+# Each connection gets a thread, but statements are parsed in a pool of jobs worker processes, which bounds how
+# many are parsed at once; the workers stay up between requests, keeping their layout templates.
+class ParseServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    reply_keys = ('filename', 'error', 'statement', 'account', 'startDate', 'endDate', 'pages', 'records')
+
+    def __init__(self, address, parse, jobs = 1):
+        """parse is parse_file with the options to use (and keep_records) bound, for the workers to call"""
+        self.parse = parse
+        self.pool = multiprocessing.Pool(jobs)
+        SocketServer.UnixStreamServer.__init__(self, address, ParseRequestHandler)
+
+    def answer(self, request):
+        if 'path' in request:
+            result = self.pool.apply(self.parse, (request['path'],))
+        elif 'data' in request:
+            with tempfile.NamedTemporaryFile(suffix = '.pdf', delete = False) as f:
+                f.write(base64.b64decode(request['data']))
+            try:
+                result = self.pool.apply(self.parse, (f.name,))
+            finally:
+                os.remove(f.name)
+            result['filename'] = request.get('name', '')
+        else:
+            return dict(error = 'request needs a path or data')
+        return dict((key, result[key]) for key in self.reply_keys if key in result)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+class ParseRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.answer(json.loads(line))
+            except Exception:
+                reply = dict(error = traceback.format_exc())
+            self.wfile.write(json.dumps(reply, default = json_dates, sort_keys = True) + '\n')
+            self.wfile.flush()
+
+def json_dates(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+def serve(address, parse, jobs = 1):
+    """Run a ParseServer on the Unix socket address until interrupted or terminated"""
+    if os.path.exists(address):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except socket.error:
+            os.remove(address) # left over from a server that didn't shut down cleanly
+        else:
+            raise RuntimeError("%s is already being served" % (address))
+        finally:
+            probe.close()
+    server = ParseServer(address, parse, jobs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def request_parse(address, requests):
+    """Send requests to a ParseServer on the Unix socket address, over one connection, generating its replies in order"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(address)
+    stream = connection.makefile('r+b')
+    try:
+        for request in requests:
+            stream.write(json.dumps(request) + '\n')
+            stream.flush()
+            yield json.loads(stream.readline())
+    finally:
+        stream.close()
+        connection.close()